@@ -1,15 +1,20 @@
 import random
 from abc import ABC, abstractmethod
 from room_events import EventType, RoomEvent
-from logger import Logger
+from logger import Logger, LogEvent
 from mlsolver.formula import *
 
 
-def create_agents(game_map, km, num_crew, num_imp, num_tasks, num_visuals, cooldown, stat_thres):
-    """Utility function to create an agent set with tasks, impostors"""
-    agents = [Crewmate(x, num_crew, num_imp, game_map, km, num_tasks, num_visuals) for x in range(num_crew)]
+def create_agents(game_map, km, num_crew, num_imp, num_tasks, num_visuals, cooldown, stat_thres, rngs=None):
+    """Utility function to create an agent set with tasks, impostors.
+    rngs holds a random.Random stream for each agent ID. If not given, all agents use the global random module"""
+    if rngs is None:
+        rngs = [random for _ in range(num_crew + num_imp)]
+
+    agents = [Crewmate(x, num_crew, num_imp, game_map, km, num_tasks, num_visuals, rngs[x]) for x in range(num_crew)]
     # noinspection PyTypeChecker
-    [agents.append(Impostor(num_crew + x, num_crew, num_imp, game_map, km, cooldown, stat_thres)) for x in range(num_imp)]
+    [agents.append(Impostor(num_crew + x, num_crew, num_imp, game_map, km, cooldown, stat_thres, rngs[num_crew + x]))
+     for x in range(num_imp)]
 
     return agents
 
@@ -18,8 +23,10 @@ class Agent(ABC):
     """
     An abstract class which contains all functions an agent must have in order to ensure a proper simulation flow
     """
-    def __init__(self, agent_id, num_crew, num_imp, game_map, km):
+    def __init__(self, agent_id, num_crew, num_imp, game_map, km, rng=random):
         self.agent_id = agent_id
+        # The source of all random decisions of this agent
+        self.rng = rng
         self.game_map = game_map
         self.km = km
         self.num_crew = num_crew
@@ -79,10 +86,10 @@ class Crewmate(Agent):
     This class provides the behaviour of a crewmate in all phases of the simulation
     """
 
-    def __init__(self, agent_id, num_crew, num_imp, game_map, km, num_tasks, num_visuals):
-        super().__init__(agent_id, num_crew, num_imp, game_map, km)
+    def __init__(self, agent_id, num_crew, num_imp, game_map, km, num_tasks, num_visuals, rng=random):
+        super().__init__(agent_id, num_crew, num_imp, game_map, km, rng)
 
-        self.tasks = game_map.create_tasks_unique(num_tasks, num_visuals)
+        self.tasks = game_map.create_tasks_unique(num_tasks, num_visuals, self.rng)
         self.goal = None
         self.goal_history = []
 
@@ -92,11 +99,8 @@ class Crewmate(Agent):
     def act(self):
         """Try to complete the goal that is currently set, or else move"""
         if self.goal and self.room is self.goal.room_id:
-            self.logger.log(
-                f"Crewmate {self.agent_id} completed their goal: {self.goal.name} in " +
-                f"{self.game_map.room_names[self.goal.room_id]}",
-                Logger.PRINT_VISUAL | Logger.LOG
-            )
+            self.logger.log_event(LogEvent.GOAL_COMPLETED, Logger.PRINT_VISUAL | Logger.LOG, self.agent_id,
+                                  payload=self.describe_goal)
 
             # If we perform an action in a room, we can only see the room in which the action is performed.
             self.location_history.append(self.room)
@@ -113,10 +117,8 @@ class Crewmate(Agent):
             if self.tasks:
                 self.goal = self.tasks.pop()
                 self.goal_history.append(self.goal)
-                self.logger.log(
-                    f"Crewmate {self.agent_id} set as goal: {self.goal.name} in" +
-                    f" {self.game_map.room_names[self.goal.room_id]}",
-                    Logger.LOG | Logger.PRINT_VISUAL)
+                self.logger.log_event(LogEvent.GOAL_SET, Logger.LOG | Logger.PRINT_VISUAL, self.agent_id,
+                                      payload=self.describe_goal)
             else:
                 self.room = self.game_map.move_random(self)
                 self.location_history.append(self.room)
@@ -133,48 +135,29 @@ class Crewmate(Agent):
         """Observe the current room, the previous room, and all events that occurred there"""
 
         # After acting, it is guaranteed that there are at least 2 rooms in memory.
-        origin_room_evts = self.game_map.get_room_events(self.location_history[-2])
-        target_room_evts = self.game_map.get_room_events(self.location_history[-1])
-
-        # origin_room_evts now contains events in both rooms
-        origin_room_evts.extend(target_room_evts)
+        # Only the latest event of each type counts, and the current room's events are later than the previous room's
+        rooms = self.location_history[-2:]
 
-        corpse_found = -1
-        agent_id_kill_witnessed = -1
-        agent_id_task_witnessed = -1
+        agent_id_kill_witnessed = self.game_map.get_latest_event(EventType.KILL, rooms)
+        # This is the ID of the agent that performed the task
+        agent_id_task_witnessed = self.game_map.get_latest_event(EventType.TASK_VISUAL, rooms)
+        # This is the ID of the agent that is found dead
+        corpse_found = self.game_map.get_latest_event(EventType.CORPSE, rooms)
 
-        for evt in origin_room_evts:
-            if evt.type == EventType.KILL:
-                agent_id_kill_witnessed = evt.agent_id
-            elif evt.type == EventType.TASK_VISUAL:
-                agent_id_task_witnessed = evt.agent_id # This is the ID of the agent that performed the task
-            elif evt.type == EventType.CORPSE:
-                corpse_found = evt.agent_id # This is the ID of the agent that is found dead
-
-        self.update_knowledge_during_game(agents, agent_id_kill_witnessed, agent_id_task_witnessed)
+        self.update_knowledge_during_game(agent_id_kill_witnessed, agent_id_task_witnessed)
         return corpse_found
 
-    def update_knowledge_during_game(self, agents, agent_id_kill_witnessed, agent_id_task_witnessed):
-        # Check which agents are roommates (and which are not)
-        agents_in_same_room = []
-        agents_elsewhere = []
-        for a in agents:
-            if a.agent_id is not self.agent_id:
-                if a.location_history[-1] is self.location_history[-1]:
-                    agents_in_same_room.append(a)
-                else:
-                    agents_elsewhere.append(a)
-
-        if agents_in_same_room:
+    def update_knowledge_during_game(self, agent_id_kill_witnessed, agent_id_task_witnessed):
+        # Every agent on the map is in the room of its last location, so the map knows if we have roommates
+        if self.game_map.count_in_room(self.location_history[-1]) > 1:
             # Catching the impostor on the body
             if agent_id_kill_witnessed != -1:
                 self.km.update_known_impostor(self.agent_id, agent_id_kill_witnessed)
 
             # Clearing a crewmate by seeing their task:
             elif agent_id_task_witnessed != -1:
-                self.logger.log(f"{self.agent_id} witnessed task {agent_id_task_witnessed}",
-                                Logger.LOG | Logger.PRINT_VISUAL
-                )
+                self.logger.log_event(LogEvent.WITNESS_TASK, Logger.LOG | Logger.PRINT_VISUAL,
+                                      self.agent_id, agent_id_task_witnessed)
 
                 self.km.update_known_crewmate(self.agent_id, agent_id_task_witnessed)
                 self.trusted_agents[agent_id_task_witnessed] = True
@@ -183,17 +166,21 @@ class Crewmate(Agent):
         return self.km.retrieve_knowledge(self.agent_id)
 
     def receive(self, announced):
+        """Updates the knowledge with the announcements of the trusted agents, and returns their IDs"""
         super().receive(announced)
 
+        trusted = []
         for i in range(self.num_crew + self.num_imp):
             if self.trusted_agents[i] and i is not self.agent_id:
 
                 if self.announcement_set[i] is not None:
                     formula = self.announcement_set[i].inner
-                    self.logger.log(f"{self.agent_id} trusts {i} On formula: {formula}",
-                                    Logger.LOG | Logger.PRINT_VISUAL
-                    )
+                    self.logger.log_event(LogEvent.TRUST, Logger.LOG | Logger.PRINT_VISUAL,
+                                          self.agent_id, i, formula)
                     self.km.update(self.agent_id, formula)
+                    trusted.append(i)
+
+        return trusted
 
     def vote(self, agents):
         """Crewmates vote for an agent if they're sure they are the impostor.
@@ -206,24 +193,24 @@ class Crewmate(Agent):
         for a in agents:
             if self.km.knows_imp(self.agent_id, a.agent_id):
                 known_impostor = a.agent_id
-                self.logger.log(f"Crewmate {self.agent_id} suspects {a.agent_id}", Logger.LOG | Logger.PRINT_VISUAL)
+                self.logger.log_event(LogEvent.SUSPECT, Logger.LOG | Logger.PRINT_VISUAL, self.agent_id, a.agent_id)
             elif self.km.suspects(self.agent_id, a.agent_id):
                 suspects.append(a.agent_id)
-                self.logger.log(f"Crewmate {self.agent_id} suspects {a.agent_id}", Logger.LOG | Logger.PRINT_VISUAL)
+                self.logger.log_event(LogEvent.SUSPECT, Logger.LOG | Logger.PRINT_VISUAL, self.agent_id, a.agent_id)
 
         if known_impostor != -1:
             vote = known_impostor
         else:
             # Randomly vote for an agent on the suspect-list
-            vote = random.sample(suspects, 1)[0]
+            vote = self.rng.sample(suspects, 1)[0]
 
             # If you are not yet sure, there is a probability that you vote pass.
             # This probability increases if you suspect more people (and are therefore less sure)
             threshold = (len(suspects) / (self.num_crew + self.num_imp)) * 0.5
-            if random.random() < threshold:
+            if self.rng.random() < threshold:
                 vote = -1
 
-        self.logger.log(f"Crewmate {self.agent_id} votes for {vote}\n", Logger.PRINT_VISUAL | Logger.LOG)
+        self.logger.log_event(LogEvent.CREW_VOTE, Logger.PRINT_VISUAL | Logger.LOG, self.agent_id, vote)
         return vote
 
     def is_impostor(self):
@@ -236,6 +223,9 @@ class Crewmate(Agent):
     def has_tasks_left(self):
         return len(self.tasks) > 0
 
+    def describe_goal(self):
+        return f"{self.goal.name} in {self.game_map.room_names[self.goal.room_id]}"
+
     def get_info(self):
 
         goal_line = ""
@@ -254,7 +244,7 @@ class Crewmate(Agent):
 
 class Impostor(Agent):
 
-    def __init__(self, agent_id, num_crew, num_imp, game_map, km, cooldown, stat_threshold):
+    def __init__(self, agent_id, num_crew, num_imp, game_map, km, cooldown, stat_threshold, rng=random):
         self.cooldown = cooldown
         self.cooldown_ctr = self.cooldown
         self.target = -1
@@ -262,38 +252,35 @@ class Impostor(Agent):
         # Stationary threshold: Threshold for standing still instead of moving during move function
         self.stat_threshold = stat_threshold
 
-        super().__init__(agent_id, num_crew, num_imp, game_map, km)
+        super().__init__(agent_id, num_crew, num_imp, game_map, km, rng)
 
     def act(self):
         """Try to kill if possible, otherwise, move about randomly"""
 
-        current_room = self.game_map.rooms[self.room]
-
         if self.cooldown_ctr == 0:
-            num_others = sum(current_room) - 1
+            num_others = self.game_map.count_in_room(self.room) - 1
 
             if num_others:
                 # How likely it is to kill is proportional to the amount of other people present in the room
-                threshold = 1 - (num_others / len(current_room))
+                threshold = 1 - (num_others / self.game_map.num_agents)
 
-                if random.random() < threshold:
+                if self.rng.random() < threshold:
                     # Kill!
                     # Select the IDs of all others in the room that are present and are not one of the impostors
                     # This is easily changed for multiple known impostor IDs
                     # IDs from Impostors start at self.num_crew and go up to self.num_crew + self.num_imp - 1
 
-                    present_crewmates = [x for x in range(len(current_room)) if
-                                         not current_room[x] == 0 and not x >= self.num_crew]
+                    present_crewmates = [x for x in self.game_map.agents_in_room(self.room) if x < self.num_crew]
 
                     # If we are in a room with only impostors, this can happen
                     if len(present_crewmates) == 0:
                         return
 
-                    to_kill = random.sample(present_crewmates, 1)[0]
+                    to_kill = self.rng.sample(present_crewmates, 1)[0]
 
                     self.game_map.add_room_event(self.room, RoomEvent(EventType.KILL, self.agent_id, "Kill"))
 
-                    self.logger.log(f"Impostor {self.agent_id} kills {to_kill}!", Logger.LOG | Logger.PRINT_VISUAL)
+                    self.logger.log_event(LogEvent.KILL, Logger.LOG | Logger.PRINT_VISUAL, self.agent_id, to_kill)
 
                     self.reset_cooldown()
 
@@ -305,7 +292,7 @@ class Impostor(Agent):
         self.__move()
 
     def __move(self):
-        if random.random() > self.stat_threshold:
+        if self.rng.random() > self.stat_threshold:
             self.room = self.game_map.move_random(self)
 
         self.location_history.append(self.room)
@@ -320,7 +307,9 @@ class Impostor(Agent):
 
     def receive(self, announced):
         super().receive(announced)
-        self.logger.log(f"Announced: {self.announcement_set}", Logger.LOG | Logger.PRINT_VISUAL)
+        # The formulas are logged as text, as their default representation holds their address
+        self.logger.log_event(LogEvent.ANNOUNCE, Logger.LOG | Logger.PRINT_VISUAL, self.agent_id,
+                              payload=lambda: str([None if f is None else str(f) for f in self.announcement_set]))
 
     def choose_target(self, agents):
         """The impostor chooses a target to vote off. It chooses the crewmate
@@ -350,10 +339,10 @@ class Impostor(Agent):
         if self.target != -1:
             vote = self.target
         else: # Vote a random living agents
-            vote = random.sample([a.agent_id for a in agents if not a.agent_id == self.agent_id and a.alive and not a.is_impostor()], 1)[0]
+            vote = self.rng.sample([a.agent_id for a in agents if not a.agent_id == self.agent_id and a.alive and not a.is_impostor()], 1)[0]
 
         self.target = -1
-        self.logger.log(f"Impostor {self.agent_id} votes for {vote}", Logger.LOG | Logger.PRINT_VISUAL)
+        self.logger.log_event(LogEvent.IMP_VOTE, Logger.LOG | Logger.PRINT_VISUAL, self.agent_id, vote)
         return vote
 
     def round_reset(self):
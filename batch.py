@@ -0,0 +1,250 @@
+"""
+    Running many headless simulations in parallel. Every worker process builds its own map, Kripke model and
+    controller, and logs into its own Logger. The logs of all workers are merged into one log file, which is written
+    while the workers finish their shards.
+    A sweep does the same for many configs at once, see sweep_headless_run.
+    In a stats only run, nothing is logged, and the stats tables of all workers are merged instead, see game_stats.py.
+"""
+
+import json
+import os
+import numpy as np
+
+from itertools import product
+
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from map import FileMap, SIMPLE_SKELD_FILE, load_map_definition
+from controller import Controller
+from logger import Logger, LogWriter
+from game_stats import save_game_stats
+from mlsolver.model import AmongUsKripke, AmongUsOneImp, AmongUsTwoImp, AmongUsNImp
+from util.util import Message
+
+
+# Simulations built in this process by config, reused by later shards with the same config
+simulations = {}
+
+
+def validate_config(config):
+    """Returns a message describing why a config cannot be simulated, or None if it can"""
+    if config["num_visuals"] > config["num_tasks"]:
+        return "Visuals cannot be set higher than the number of tasks available"
+    if config["num_imp"] < 1:
+        return "At least one impostor is required."
+    if config["engine"] not in AmongUsKripke.ENGINES:
+        return f"Supported Kripke engines are: {', '.join(AmongUsKripke.ENGINES)}"
+
+    map_file_name = config.get("map", SIMPLE_SKELD_FILE)
+    if not os.path.exists(map_file_name):
+        return f"Map file {map_file_name} does not exist"
+    try:
+        definition = load_map_definition(map_file_name)
+    except (ValueError, KeyError, TypeError) as e:
+        return f"Map file {map_file_name} is invalid: {e}"
+    if config["num_tasks"] > len(definition["tasks"]):
+        return f"The map has only {len(definition['tasks'])} tasks, fewer than the number of tasks"
+    return None
+
+
+def create_simulation(config, seed=None):
+    """Creates the Kripke model and the controller for a config, which holds the same keys as the run info"""
+    num_agents = config["num_crew"] + config["num_imp"]
+
+    # The map we want to use, which is the simple Skeld for configs from before maps could be chosen
+    ss = FileMap(config.get("map", SIMPLE_SKELD_FILE), num_agents)
+
+    if config["num_imp"] == 1:
+        km = AmongUsOneImp(num_agents, config["engine"])
+    elif config["num_imp"] == 2:
+        km = AmongUsTwoImp(num_agents, config["engine"])
+    else:
+        km = AmongUsNImp(num_agents, config["num_imp"], config["engine"])
+
+    # The controller controls the simulation flow
+    controller = Controller(km, ss, config["num_crew"], config["num_imp"], config["num_tasks"],
+                            config["num_visuals"], config["cooldown"], config["stat_thres"], seed)
+
+    return km, controller
+
+
+def init_worker(disabled_events):
+    """Gives the logger of a worker process the disabled events of the logger of the main process.
+    A forked worker also inherits the log file that the main process streams to, which only the main process
+    may write to: the worker keeps all events of a shard and returns them instead"""
+    logger = Logger.get_instance()
+    logger.disabled_events = set(disabled_events)
+    logger.writer = None
+
+
+def run_shard(shard):
+    """Runs a contiguous range of simulations in a worker process and returns the logged events and the stats table"""
+    config, first_run, num_runs, seed = shard
+
+    logger = Logger.get_instance()
+    logger.set_headless_mode(True)
+    logger.clear_logs()
+
+    key = (tuple(sorted(config.items())), seed)
+    if key not in simulations:
+        simulations[key] = create_simulation(config, seed)
+    km, controller = simulations[key]
+
+    # Run i is game i of the seed, so the result does not depend on how the runs are divided over workers
+    for i in range(first_run, first_run + num_runs):
+        logger.start_run(i)
+        controller.receive(Message(None, "run_to_end", {"game_index": i}))
+
+    return logger.get_events(), controller.take_game_stats()
+
+
+def split_runs(num_steps, num_shards, first_run=0):
+    """Splits the num_steps runs from first_run on into num_shards contiguous (first_run, num_runs) ranges
+    of near equal size"""
+    shards = []
+    for i in range(num_shards):
+        num_runs = num_steps // num_shards + (1 if i < num_steps % num_shards else 0)
+        if num_runs > 0:
+            shards.append((first_run, num_runs))
+        first_run += num_runs
+    return shards
+
+
+def get_default_chunk_size(num_runs, num_workers):
+    """Enough shards for every worker to take several, so that the load is balanced"""
+    return max(1, num_runs // (num_workers * 8))
+
+
+def parallel_headless_run(config, num_steps, num_workers, seed, chunk_size=None, file_name=None, log_buffer=None,
+                          log_thread=False, stats_only=False, first_run=0):
+    logger = Logger.get_instance()
+    logger.add_run_info("num_sim_runs", num_steps)
+    logger.add_run_info("first_run", first_run)
+    logger.add_run_info("num_workers", num_workers)
+
+    if chunk_size is None:
+        chunk_size = get_default_chunk_size(num_steps, num_workers)
+
+    # A worker only keeps the events of its current shard, and the merged events are streamed to the log file
+    num_shards = (num_steps + chunk_size - 1) // chunk_size
+    shards = [(config, shard_first_run, num_runs, seed)
+              for shard_first_run, num_runs in split_runs(num_steps, num_shards, first_run)]
+
+    if not stats_only:
+        logger.open_log(file_name, log_buffer, log_thread)
+
+    tables = []
+    with Pool(num_workers, init_worker, (logger.disabled_events,)) as pool:
+        # imap keeps the order of the shards, so the merged log is ordered by run
+        for events, table in tqdm(pool.imap(run_shard, shards), total=len(shards)):
+            if stats_only:
+                tables.append(table)
+            else:
+                logger.log_events(events)
+
+    if stats_only:
+        save_game_stats(file_name, logger.run_info, np.concatenate(tables))
+    else:
+        logger.close_log()
+
+
+def run_sweep_shard(sweep_shard):
+    """Runs a shard of one config of a sweep, see run_shard"""
+    config_index, shard = sweep_shard
+    return config_index, run_shard(shard)
+
+
+def create_sweep_configs(base_config, config_overrides=None, grid=None):
+    """Creates the configs of a sweep: every override in config_overrides (a list of partial configs) combined
+    with every point of grid (a dict mapping a config key to a list of values), applied to base_config
+    """
+    if not config_overrides:
+        config_overrides = [{}]
+    if not grid:
+        grid = {}
+
+    configs = []
+    for overrides in config_overrides:
+        for values in product(*grid.values()):
+            config = dict(base_config)
+            config.update(overrides)
+            config.update(zip(grid.keys(), values))
+            configs.append(config)
+    return configs
+
+
+def parse_grid_arg(base_config, arg):
+    """Parses a grid argument of the form key=value1,value2,... into the key and the values,
+    converted to the type of the value of that key in base_config. Raises a ValueError for an invalid argument
+    """
+    if "=" not in arg:
+        raise ValueError(f"Grid argument '{arg}' is not of the form key=value1,value2,...")
+    key, values = arg.split("=", 1)
+    if key not in base_config:
+        raise ValueError(f"Unknown grid key '{key}'; valid keys: {', '.join(base_config)}")
+
+    value_type = type(base_config[key])
+    try:
+        return key, [value_type(v) for v in values.split(",")]
+    except ValueError:
+        raise ValueError(f"Grid values of '{key}' must be of type {value_type.__name__}")
+
+
+def load_sweep_configs(file_name):
+    """Loads a list of partial configs from a JSON file"""
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def sweep_headless_run(configs, num_steps, num_workers, seed, chunk_size=None, file_name=None, log_thread=False,
+                       stats_only=False, first_run=0):
+    """Runs num_steps simulations for every config. All (config, runs) shards are put into one pool,
+    from which idle workers take the next shard, so that slow configs do not hold up the others.
+    Every config plays the games of the same seed, so the configs are compared on the same random streams.
+    All results are written into a single file as the shards finish, in which every config has its own section
+    with its run info and logs.
+    """
+    logger = Logger.get_instance()
+    logger.add_run_info("num_sim_runs", num_steps)
+    logger.add_run_info("first_run", first_run)
+    logger.add_run_info("num_workers", num_workers)
+    logger.add_run_info("num_configs", len(configs))
+
+    if chunk_size is None:
+        chunk_size = get_default_chunk_size(num_steps * len(configs), num_workers)
+
+    num_shards = (num_steps + chunk_size - 1) // chunk_size
+    sweep_shards = [(config_index, (config, shard_first_run, num_runs, seed))
+                    for config_index, config in enumerate(configs)
+                    for shard_first_run, num_runs in split_runs(num_steps, num_shards, first_run)]
+
+    run_infos = []
+    for config in configs:
+        run_info = dict(config)
+        run_info["num_sim_runs"] = num_steps
+        run_info["first_run"] = first_run
+        run_infos.append(run_info)
+
+    writer = None
+    if not stats_only:
+        writer = LogWriter(Logger.get_log_file_name(file_name), log_thread)
+        writer.write_header(0, {"run_info": logger.run_info, "sweep": len(configs)})
+        for config_index, run_info in enumerate(run_infos):
+            writer.write_header(config_index + 1, {"run_info": run_info})
+
+    # The reader puts the shards of a config back in the order of their runs
+    tables = [[] for _ in configs]
+    with Pool(num_workers, init_worker, (logger.disabled_events,)) as pool:
+        for config_index, (events, table) in tqdm(pool.imap_unordered(run_sweep_shard, sweep_shards),
+                                                  total=len(sweep_shards)):
+            if stats_only:
+                tables[config_index].append(table)
+            else:
+                writer.write_events(config_index + 1, events)
+
+    if stats_only:
+        games = [np.sort(np.concatenate(config_tables), order="run") for config_tables in tables]
+        save_game_stats(file_name, logger.run_info, list(zip(run_infos, games)))
+    else:
+        writer.close()
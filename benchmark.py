@@ -0,0 +1,305 @@
+"""
+    Benchmarks of the simulation and the epistemic engine. For every combination of the given agent counts,
+    impostor counts and engines, full games are played headless, while the steps of the controller are timed
+    per phase, and the calls to AmongUsKripke.setup, kripke_structure_solve_a, retrieve_knowledge and
+    Impostor.choose_target are timed as they happen during these games.
+
+    python benchmark.py --agents 5,10,15,20 --imps 1,2 --engines set,bitset --games 20 --output results.json
+    python benchmark.py --baseline results.json      compares against earlier results
+    python benchmark.py --compare HEAD~1 HEAD        runs the benchmarks on two commits and compares them
+
+    When comparing commits, this benchmark runs on the code of each commit, which can be older than the benchmark.
+    The functions below fall back to the interfaces of older code where newer ones are missing, and skip the cases
+    that the code of a commit does not support, such as engines or impostor counts it does not have.
+"""
+
+import inspect
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+PHASES = ("ACT", "OBSERVE", "DISCUSS", "VOTE", "CHECK")
+CALLS = ("setup", "solve_a", "retrieve_knowledge", "choose_target")
+
+
+@contextmanager
+def timed(owner, name, timings):
+    """Records the duration of every call to the function name of owner in timings, while in the context.
+    Nothing is recorded if owner has no such function"""
+    original = getattr(owner, name, None)
+    if original is None:
+        yield
+        return
+
+    def timed_call(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter() - start)
+
+    setattr(owner, name, timed_call)
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def clear_logs(logger):
+    if hasattr(logger, "clear_logs"):
+        logger.clear_logs()
+    else:
+        logger.messages.clear()
+
+
+def create_benchmark_simulation(config, seed):
+    """Creates the Kripke model and the controller of a config with the code that is benchmarked, or returns None
+    if that code does not support the config"""
+    import mlsolver.model as model
+    from controller import Controller
+    from map import SimpleSkeld
+
+    if config["engine"] not in getattr(model.AmongUsKripke, "ENGINES", ("set",)):
+        return None
+    if config["num_imp"] > 2 and not hasattr(model, "AmongUsNImp"):
+        return None
+
+    # Code without seeded random streams draws from the global random module
+    random.seed(seed)
+
+    try:
+        from batch import create_simulation
+    except ImportError:
+        create_simulation = None
+    if create_simulation is not None:
+        if "seed" in inspect.signature(create_simulation).parameters:
+            return create_simulation(config, seed)
+        return create_simulation(config)
+
+    # Code from before batch.py, which created the simulation in main.py
+    num_agents = config["num_crew"] + config["num_imp"]
+    engine_args = (config["engine"],) if hasattr(model.AmongUsKripke, "ENGINES") else ()
+    if config["num_imp"] == 1:
+        km = model.AmongUsOneImp(num_agents, *engine_args)
+    elif config["num_imp"] == 2:
+        km = model.AmongUsTwoImp(num_agents, *engine_args)
+    else:
+        km = model.AmongUsNImp(num_agents, config["num_imp"], *engine_args)
+    controller = Controller(km, SimpleSkeld(num_agents), config["num_crew"], config["num_imp"], config["num_tasks"],
+                            config["num_visuals"], config["cooldown"], config["stat_thres"])
+    return km, controller
+
+
+def benchmark_case(num_agents, num_imp, engine, num_games, seed):
+    """Plays num_games games of a config, and returns the throughput and the mean latencies,
+    or None if the code that is benchmarked does not support the config"""
+    import mlsolver.model as model
+    from agent import Impostor
+    from logger import Logger
+    from mlsolver.model import AmongUsKripke
+
+    config = {
+        "num_crew": num_agents - num_imp,
+        "num_imp": num_imp,
+        "num_tasks": 10,
+        "num_visuals": 4,
+        "cooldown": 5,
+        "stat_thres": 0.5,
+        "engine": engine
+    }
+
+    logger = Logger.get_instance()
+    logger.set_headless_mode(True)
+    clear_logs(logger)
+
+    # Building the first model includes building the template of the initial Kripke structure
+    if hasattr(AmongUsKripke, "templates"):
+        AmongUsKripke.templates.clear()
+    start = time.perf_counter()
+    simulation = create_benchmark_simulation(config, seed)
+    build_time = time.perf_counter() - start
+    if simulation is None:
+        return None
+    km, controller = simulation
+    selects_game = "game_index" in inspect.signature(controller.reset).parameters
+
+    phase_times = defaultdict(list)
+    call_times = {name: [] for name in CALLS}
+    num_steps = 0
+
+    with timed(type(km), "setup", call_times["setup"]), \
+            timed(model, "kripke_structure_solve_a", call_times["solve_a"]), \
+            timed(AmongUsKripke, "retrieve_knowledge", call_times["retrieve_knowledge"]), \
+            timed(Impostor, "choose_target", call_times["choose_target"]):
+
+        start = time.perf_counter()
+        for game_index in range(num_games):
+            if selects_game:
+                controller.reset(game_index)
+            else:
+                controller.reset()
+            while not controller.is_game_over:
+                phase = controller.phase.name
+                step_start = time.perf_counter()
+                controller.step()
+                phase_times[phase].append(time.perf_counter() - step_start)
+                num_steps += 1
+
+            # The events are part of the simulation, but are not kept between games
+            clear_logs(logger)
+        total_time = time.perf_counter() - start
+
+    return {
+        "num_agents": num_agents,
+        "num_imp": num_imp,
+        "engine": engine,
+        "games": num_games,
+        "steps": num_steps,
+        "games_per_sec": num_games / total_time,
+        "build_ms": build_time * 1e3,
+        "phase_us": {phase: mean(times) * 1e6 for phase, times in phase_times.items()},
+        "call_us": {name: mean(times) * 1e6 if times else None for name, times in call_times.items()},
+    }
+
+
+def run_benchmarks(agent_counts, imp_counts, engines, num_games, seed):
+    results = []
+    for num_agents in agent_counts:
+        for num_imp in imp_counts:
+            # With as many impostors as crewmates, the game is over before it starts
+            if num_agents - num_imp <= num_imp:
+                continue
+            for engine in engines:
+                result = benchmark_case(num_agents, num_imp, engine, num_games, seed)
+                if result is None:
+                    print(f"Skipping {num_agents} agents, {num_imp} impostors, {engine}: not supported by this code")
+                    continue
+                print_results([result], header=not results)
+                results.append(result)
+    return results
+
+
+def format_value(value, width):
+    return f"{value:>{width}.1f}" if value is not None else f"{'-':>{width}}"
+
+
+def print_results(results, header=True):
+    if header:
+        print(f"{'agents':>6} {'imps':>4} {'engine':>9} {'games/s':>8} {'build ms':>9} " +
+              " ".join(f"{phase + ' us':>11}" for phase in PHASES) + " " +
+              " ".join(f"{name + ' us':>21}" for name in CALLS))
+    for r in results:
+        print(f"{r['num_agents']:>6} {r['num_imp']:>4} {r['engine']:>9} {r['games_per_sec']:>8.1f} "
+              f"{r['build_ms']:>9.1f} " +
+              " ".join(format_value(r["phase_us"].get(phase), 11) for phase in PHASES) + " " +
+              " ".join(format_value(r["call_us"].get(name), 21) for name in CALLS), flush=True)
+
+
+def compare_results(baseline, results, baseline_name="baseline", results_name="current"):
+    """Prints the throughput and latencies of results relative to those of the same cases in baseline.
+    A ratio above 1 means results is faster"""
+    cases = {(r["num_agents"], r["num_imp"], r["engine"]): r for r in baseline}
+
+    print(f"{'agents':>6} {'imps':>4} {'engine':>9} {baseline_name[:12]:>12} {results_name[:12]:>12} {'speedup':>8} "
+          + " ".join(f"{name:>12}" for name in PHASES + CALLS))
+    for r in results:
+        b = cases.get((r["num_agents"], r["num_imp"], r["engine"]))
+        if b is None:
+            continue
+
+        latencies = [(b["phase_us"].get(phase), r["phase_us"].get(phase)) for phase in PHASES] + \
+                    [(b["call_us"].get(name), r["call_us"].get(name)) for name in CALLS]
+        ratios = [format_value(old / new, 12) if old and new else format_value(None, 12) for old, new in latencies]
+
+        print(f"{r['num_agents']:>6} {r['num_imp']:>4} {r['engine']:>9} {b['games_per_sec']:>12.1f} "
+              f"{r['games_per_sec']:>12.1f} {r['games_per_sec'] / b['games_per_sec']:>8.2f} " + " ".join(ratios))
+
+
+def run_on_commit(commit, benchmark_args):
+    """Runs this benchmark on the code of a commit, checked out in a temporary worktree, and returns its results"""
+    worktree = tempfile.mkdtemp(prefix="benchmark_")
+    output = os.path.join(worktree, "benchmark_results.json")
+    subprocess.run(["git", "worktree", "add", "--detach", worktree, commit], check=True)
+    try:
+        print(f"Benchmarking {commit}")
+        subprocess.run([sys.executable, os.path.abspath(__file__), *benchmark_args, "--root", worktree,
+                        "--output", output], check=True)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        subprocess.run(["git", "worktree", "remove", "--force", worktree], check=True)
+
+
+if __name__ == "__main__":
+
+    agent_counts = [5, 10, 15, 20]
+    imp_counts = [1, 2]
+    engines = ["set", "bitset", "subset"]
+    num_games = 20
+    seed = 0
+
+    output_file_name = None
+    baseline_file_name = None
+    compare = None
+    # The code that is benchmarked, which is the code of another commit when comparing commits
+    root = None
+
+    benchmark_args = []
+    for i, arg in enumerate(sys.argv):
+        if arg == "--agents":
+            agent_counts = [int(n) for n in sys.argv[i + 1].split(",")]
+        elif arg == "--imps":
+            imp_counts = [int(n) for n in sys.argv[i + 1].split(",")]
+        elif arg == "--engines":
+            engines = sys.argv[i + 1].split(",")
+        elif arg == "--games":
+            num_games = int(sys.argv[i + 1])
+        elif arg == "--seed":
+            seed = int(sys.argv[i + 1])
+        elif arg == "--output":
+            output_file_name = sys.argv[i + 1]
+        elif arg == "--baseline":
+            baseline_file_name = sys.argv[i + 1]
+        elif arg == "--compare":
+            compare = sys.argv[i + 1:i + 3]
+        elif arg == "--root":
+            root = sys.argv[i + 1]
+        else:
+            continue
+
+        if arg in ("--agents", "--imps", "--engines", "--games", "--seed"):
+            benchmark_args += [arg, sys.argv[i + 1]]
+
+    if compare is not None:
+        if len(compare) != 2:
+            print("Comparing requires two commits.")
+            exit(1)
+        results_a = run_on_commit(compare[0], benchmark_args)
+        results_b = run_on_commit(compare[1], benchmark_args)
+        compare_results(results_a, results_b, compare[0], compare[1])
+        exit(0)
+
+    if root is not None:
+        sys.path.insert(0, root)
+        os.chdir(root)
+
+    results = run_benchmarks(agent_counts, imp_counts, engines, num_games, seed)
+
+    if output_file_name is not None:
+        with open(output_file_name, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline_file_name is not None:
+        with open(baseline_file_name) as f:
+            compare_results(json.load(f), results)
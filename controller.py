@@ -1,8 +1,11 @@
+import random
+
 from agent import create_agents
 from util.util import Message, LMObject
 from collections import Counter
 from enum import Enum
-from logger import Logger
+from logger import Logger, LogEvent
+from game_stats import GameStats, Outcome, create_stats_table
 
 
 class Phase(Enum):
@@ -20,7 +23,7 @@ class Controller(LMObject):
     """
 
     # on reset. Perhaps move to a custom function where we can 'init' agents on their own?
-    def __init__(self, km, game_map, num_crew, num_imp, num_tasks, num_visuals, cooldown, stat_thres):
+    def __init__(self, km, game_map, num_crew, num_imp, num_tasks, num_visuals, cooldown, stat_thres, seed=None):
         super().__init__()
 
         self.km = km
@@ -33,6 +36,15 @@ class Controller(LMObject):
         self.stat_thres = stat_thres
         self.count_crewmate_wins = 0
 
+        # Every game has its own random streams, derived from the seed and the index of the game,
+        # such that any game can be replayed on its own
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.game_index = 0
+
+        # The counters of the current game, and the rows of the games that have ended
+        self.game_stats = GameStats(self.game_index)
+        self.finished_game_stats = []
+
         self.logger = Logger.get_instance()
 
         self.agents = []
@@ -40,20 +52,29 @@ class Controller(LMObject):
 
         # self.phases = ["act", "observe", "discuss", "vote", "check"]
         self.phase = Phase.ACT
+        self.step_count = 0
 
         self.is_game_over = False
         self.run_continuously = False
 
+    def create_rngs(self):
+        """Creates an independent random stream for each agent in the current game"""
+        return [random.Random(f"{self.seed}:{self.game_index}:{agent_id}")
+                for agent_id in range(self.num_crew + self.num_imp)]
+
     def reset_agents(self):
         self.agents = create_agents(self.game_map, self.km, self.num_crew, self.num_imp, self.num_tasks, self.num_visuals,
-                                    self.cooldown, self.stat_thres)
+                                    self.cooldown, self.stat_thres, self.create_rngs())
 
-    def reset(self):
-        """Resets the simulation"""
+    def reset(self, game_index=None):
+        """Resets the simulation, to the given game or else to the next one"""
+        self.game_index = game_index if game_index is not None else self.game_index + 1
         self.km.reset()
         self.game_map.map_reset()
         self.reset_agents()
         self.phase = Phase.ACT
+        self.step_count = 0
+        self.game_stats = GameStats(self.game_index)
         self.is_game_over = False
         self.send(Message(self, "update", None))
         self.send(Message(self, "clear", None))
@@ -63,11 +84,14 @@ class Controller(LMObject):
         if self.is_game_over:
             return
 
-        self.logger.log(f"{self.phase}", Logger.LOG | Logger.PRINT_VISUAL)
+        self.logger.set_step(self.step_count, self.phase.value)
+        self.logger.log_event(LogEvent.PHASE, Logger.LOG | Logger.PRINT_VISUAL, payload=self.phase.name)
+        self.step_count += 1
 
         next_phase = (self.phase.value + 1) % len(Phase)
 
         if self.phase == Phase.ACT:
+            self.game_stats.rounds += 1
 
             # To allow for more deterministic behaviour, let the impostors go first
             # Removal of dead agents happens in 2 steps: From the map, and from the agent set of agents
@@ -84,6 +108,7 @@ class Controller(LMObject):
                 if kill is not None:
                     self.__remove_agent_with_id_from_map(kill)
                     kills.append(kill)
+                    self.game_stats.kills += 1
 
             for kill in kills:
                 self.__remove_agent_with_id_from_set(kill)
@@ -128,7 +153,11 @@ class Controller(LMObject):
             for a in self.agents:
                 announced[a.agent_id] = a.announce()
 
-            [a.receive(announced) for a in self.agents]
+            self.game_stats.meetings += 1
+            for a in self.agents:
+                trusted = a.receive(announced)
+                if trusted:
+                    self.game_stats.add_trusts(a.agent_id, trusted)
 
             # Update Crewmate Knowledge about who possibly lied?
             # [a.update_knowledge_after_discussion(self.agents) for a in self.agents if not a.is_impostor()]
@@ -147,15 +176,15 @@ class Controller(LMObject):
 
             # If there is a tie, do not continue voting
             if top_votes[0][1] == top_votes[1][1] and len(top_votes) > 1:
-                self.logger.log("A tie: No agent was voted off.", Logger.LOG | Logger.PRINT_VISUAL)
+                self.logger.log_event(LogEvent.TIE, Logger.LOG | Logger.PRINT_VISUAL)
             elif top_votes[0][0] == -1:
                 # Most agents voted for a tie, do not continue voting
-                self.logger.log("Most agents pass: No agent was voted off.", Logger.LOG | Logger.PRINT_VISUAL)
+                self.logger.log_event(LogEvent.PASS, Logger.LOG | Logger.PRINT_VISUAL)
             else:
                 # Remove agent with most votes from the game
                 self.__remove_agent_with_id(top_votes[0][0], voted_off=True)
-                self.logger.log(f"Agent {top_votes[0][0]} received the most votes and is voted off.",
-                                Logger.LOG | Logger.PRINT_VISUAL)
+                self.game_stats.voted_off += 1
+                self.logger.log_event(LogEvent.VOTED_OFF, Logger.LOG | Logger.PRINT_VISUAL, top_votes[0][0])
 
 
         elif self.phase == Phase.CHECK:
@@ -196,14 +225,14 @@ class Controller(LMObject):
 
             if num_imps == 0:
                 self.send(Message(self, "game_over", {"victor": "crewmates"}))
-                self.logger.log("Crewmates win!", Logger.LOG | Logger.PRINT_VISUAL)
-                self.is_game_over = True
+                self.logger.log_event(LogEvent.CREW_WIN_VOTE, Logger.LOG | Logger.PRINT_VISUAL)
+                self.end_game(Outcome.CREW_VOTE)
                 self.count_crewmate_wins = self.count_crewmate_wins + 1
                 return
             elif num_imps >= num_crew:
                 self.send(Message(self, "game_over", {"victor": "impostor(s)"}))
-                self.logger.log("Impostors win!", Logger.LOG | Logger.PRINT_VISUAL)
-                self.is_game_over = True
+                self.logger.log_event(LogEvent.IMP_WIN, Logger.LOG | Logger.PRINT_VISUAL)
+                self.end_game(Outcome.IMPOSTORS)
                 return
 
             # Tasks
@@ -214,10 +243,20 @@ class Controller(LMObject):
 
             # If we reach this, no agents have tasks left
             self.send(Message(self, "game_over", {"victor": "crewmates"}))
-            self.logger.log("Crewmates win! (tasks)", Logger.LOG | Logger.PRINT_VISUAL)
-            self.is_game_over = True
+            self.logger.log_event(LogEvent.CREW_WIN_TASKS, Logger.LOG | Logger.PRINT_VISUAL)
+            self.end_game(Outcome.CREW_TASKS)
             self.count_crewmate_wins += 1
 
+    def end_game(self, outcome):
+        self.is_game_over = True
+        self.finished_game_stats.append(self.game_stats.get_row(outcome))
+
+    def take_game_stats(self):
+        """Returns the stats table of the games that have ended since the last call"""
+        table = create_stats_table(self.finished_game_stats)
+        self.finished_game_stats = []
+        return table
+
     def __remove_agent_with_id_from_map(self, agent_id, voted_off=False):
         dead_agent = self.get_agent_with_id(agent_id)
 
@@ -249,7 +288,7 @@ class Controller(LMObject):
             self.reset()
             self.run_continuously = not self.run_continuously
         elif message.name == "run_to_end":
-            self.reset()
+            self.reset(message.information["game_index"] if message.information else None)
             self.run_to_end()
         elif message.name == "run_hundred_times":
             self.reset()
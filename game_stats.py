@@ -0,0 +1,77 @@
+from enum import IntEnum
+from logger import Logger
+import json
+import os
+import numpy as np
+"""
+    Summary counters of each game, kept by the controller. In a stats only run, these are the only results:
+    nothing is logged, and the counters of all games are saved as one compact table.
+
+    The tables are saved as a results store: a folder with a .npy file for every column, which can be memory mapped,
+    and a small JSON header with the run info of every config. The games are stored ordered by config and run,
+    so the games of a config are a contiguous slice of every column.
+"""
+
+
+class Outcome(IntEnum):
+    CREW_VOTE = 0
+    CREW_TASKS = 1
+    IMPOSTORS = 2
+
+
+# One row per game. The winner follows from the outcome: the crewmates win unless it is IMPOSTORS
+GAME_STATS_DTYPE = np.dtype([("run", "<u4"), ("outcome", "u1"), ("rounds", "<u2"), ("meetings", "<u2"),
+                             ("kills", "<u2"), ("voted_off", "<u2"), ("trusts", "<u2")])
+
+
+class GameStats:
+    """The counters of the game that is being played"""
+
+    def __init__(self, run):
+        self.run = run
+        self.rounds = 0
+        self.meetings = 0
+        self.kills = 0
+        self.voted_off = 0
+        # Distinct (crewmate, trusted agent) pairs of which the announcement was used
+        self.trust_relations = set()
+
+    def add_trusts(self, agent_id, trusted):
+        self.trust_relations.update((agent_id, i) for i in trusted)
+
+    def get_row(self, outcome):
+        return (self.run, outcome, self.rounds, self.meetings, self.kills, self.voted_off, len(self.trust_relations))
+
+
+def create_stats_table(rows):
+    return np.array(rows, dtype=GAME_STATS_DTYPE)
+
+
+def save_game_stats(file_name, run_info, games):
+    """Saves the stats table of a run, or of each config of a sweep if games is a list of (run_info, table)"""
+    sweep = isinstance(games, list)
+    if sweep:
+        configs = [config_run_info for config_run_info, _ in games]
+        tables = [table for _, table in games]
+    else:
+        configs = [run_info]
+        tables = [games]
+
+    folder = Logger.get_log_file_name(file_name, ".amstats")
+    os.makedirs(folder, exist_ok=True)
+
+    # The header of a store that is overwritten would mark it complete while its columns are being replaced
+    header_file_name = f"{folder}/header.json"
+    if os.path.exists(header_file_name):
+        os.remove(header_file_name)
+
+    table = np.concatenate(tables) if tables else create_stats_table([])
+    for name in GAME_STATS_DTYPE.names:
+        np.save(f"{folder}/{name}.npy", np.ascontiguousarray(table[name]))
+
+    # The header is written last, so that a store without header is known to be incomplete
+    config_offsets = np.cumsum([0] + [len(t) for t in tables]).tolist()
+    header = {"run_info": run_info, "sweep": sweep, "configs": configs, "config_offsets": config_offsets,
+              "columns": list(GAME_STATS_DTYPE.names)}
+    with open(header_file_name, "w") as f:
+        json.dump(header, f)
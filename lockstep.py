@@ -0,0 +1,468 @@
+"""
+    Simulation of many games at once, in lockstep. The state of all games is held in NumPy arrays with one row per
+    game, and each phase is carried out for all games in that phase by array operations, instead of by stepping the
+    agents of one game at a time. It plays by the same rules as the Controller, with its own random streams, so it
+    gives the same statistics rather than the same games. It only produces the stats table of every game, see
+    game_stats.py. validate_lockstep compares its statistics with those of the Controller.
+
+    A crewmate observes the latest events of the last ACT phase in the room it came from and the room it is in,
+    as in Crewmate.observe.
+
+    The Kripke model is not built. Every update the crewmates make, whether from witnessing, from corpses or from
+    trusted announcements, is a conjunction of literals IsImp:j or not IsImp:j, so the worlds a crewmate considers
+    possible in the real world are exactly those that agree with the agents they know to be impostors and the agents
+    they know to be crewmates. These two sets, closed under the number of impostors, are all a crewmate knows.
+"""
+
+import sys
+import time
+import numpy as np
+
+from controller import Phase
+from game_stats import GAME_STATS_DTYPE, Outcome, save_game_stats
+
+
+class LockstepSimulation:
+
+    def __init__(self, config, game_map, num_games, seed=None, first_run=0):
+        self.num_crew = config["num_crew"]
+        self.num_imp = config["num_imp"]
+        self.num_agents = self.num_crew + self.num_imp
+        self.num_tasks = config["num_tasks"]
+        self.num_visuals = config["num_visuals"]
+        self.cooldown_length = config["cooldown"]
+        self.stat_thres = config["stat_thres"]
+
+        self.num_games = num_games
+        self.first_run = first_run
+        self.rng = np.random.default_rng(seed)
+
+        # The map: the neighbours of every room, the next room toward every room, and the room of every task
+        self.num_rooms = game_map.room_nums
+        self.degree = np.array([len(n) for n in game_map.neighbours], dtype=np.int64)
+        self.neighbours = np.zeros((self.num_rooms, self.degree.max()), dtype=np.int64)
+        for r, neighbours in enumerate(game_map.neighbours):
+            self.neighbours[r, :len(neighbours)] = neighbours
+        self.nav = np.array(game_map.nav, dtype=np.int64)
+        self.task_rooms = np.array([t.room_id for t in game_map.tasks], dtype=np.int64)
+        self.room_start = game_map.room_start
+        self.room_meeting = game_map.room_meeting
+
+        self.is_crew = np.arange(self.num_agents) < self.num_crew
+        self.reset()
+
+    def reset(self):
+        G, A, C, I = self.num_games, self.num_agents, self.num_crew, self.num_imp
+
+        self.phase = np.full(G, Phase.ACT.value)
+        self.outcome = np.full(G, -1)
+
+        self.alive = np.ones((G, A), dtype=bool)
+        self.room = np.full((G, A), self.room_start)
+        # The room of every agent before the last ACT phase, which crewmates observe together with their room
+        self.prev_room = self.room.copy()
+        self.cooldown = np.full((G, I), self.cooldown_length)
+
+        self.create_tasks()
+        self.goal = np.full((G, C), -1)
+
+        # The agents each crewmate knows to be impostor and to be crewmate. A crewmate knows it is a crewmate itself
+        self.known_imp = np.zeros((G, C, A), dtype=bool)
+        self.known_crew = np.zeros((G, C, A), dtype=bool)
+        self.known_crew[:, np.arange(C), np.arange(C)] = True
+        self.trusted = np.zeros((G, C, C), dtype=bool)
+        self.trusted[:, np.arange(C), np.arange(C)] = True
+        self.close_knowledge(np.arange(G))
+
+        # The last announcement of every crewmate, which is kept when it dies
+        self.has_announced = np.zeros((G, C), dtype=bool)
+        self.announced_imp = np.zeros((G, C, A), dtype=bool)
+        self.announced_crew = np.zeros((G, C, A), dtype=bool)
+
+        # The agent of the last event of each type in every room, or -1
+        self.kill_events = np.full((G, self.num_rooms), -1)
+        self.visual_task_events = np.full((G, self.num_rooms), -1)
+        self.corpses = np.full((G, self.num_rooms), -1)
+
+        self.rounds = np.zeros(G, dtype=np.int64)
+        self.meetings = np.zeros(G, dtype=np.int64)
+        self.kills = np.zeros(G, dtype=np.int64)
+        self.voted_off = np.zeros(G, dtype=np.int64)
+        self.trust_relations = np.zeros((G, C, C), dtype=bool)
+
+    def create_tasks(self):
+        """Every crewmate draws num_tasks distinct tasks, and does them last to first. As in Map.create_tasks_unique,
+        the tasks are shared, so a task is visual if it is among the first num_visuals of the last crewmate to draw it"""
+        G, C, T = self.num_games, self.num_crew, len(self.task_rooms)
+
+        drawn = np.argsort(self.rng.random((G, C, T)), axis=2)[:, :, :self.num_tasks]
+        self.task_order = drawn[:, :, ::-1].copy()
+        self.tasks_taken = np.zeros((G, C), dtype=np.int64)
+
+        # Position of every task in the draw of every crewmate, or num_tasks if it was not drawn
+        position = np.full((G, C, T), self.num_tasks)
+        np.put_along_axis(position, drawn, np.arange(self.num_tasks)[None, None, :], axis=2)
+        drawn_by = position < self.num_tasks
+        last_crewmate = C - 1 - np.argmax(drawn_by[:, ::-1, :], axis=1)
+        last_position = np.take_along_axis(position, last_crewmate[:, None, :], axis=1)[:, 0, :]
+        self.task_visual = last_position < self.num_visuals
+
+    def run(self):
+        """Plays all games to the end, and returns their stats table"""
+        handlers = {Phase.ACT.value: self.act, Phase.OBSERVE.value: self.observe, Phase.DISCUSS.value: self.discuss,
+                    Phase.VOTE.value: self.vote, Phase.CHECK.value: self.check}
+
+        while (self.outcome < 0).any():
+            running = self.outcome < 0
+            games_per_phase = [(handler, np.nonzero(running & (self.phase == phase))[0])
+                               for phase, handler in handlers.items()]
+            for handler, games in games_per_phase:
+                if len(games):
+                    handler(games)
+
+        return self.get_stats()
+
+    def get_stats(self):
+        table = np.zeros(self.num_games, dtype=GAME_STATS_DTYPE)
+        table["run"] = np.arange(self.first_run, self.first_run + self.num_games)
+        table["outcome"] = self.outcome
+        table["rounds"] = self.rounds
+        table["meetings"] = self.meetings
+        table["kills"] = self.kills
+        table["voted_off"] = self.voted_off
+        table["trusts"] = self.trust_relations.sum((1, 2))
+        return table
+
+    def random_neighbours(self, rooms):
+        choice = (self.rng.random(len(rooms)) * self.degree[rooms]).astype(np.int64)
+        return self.neighbours[rooms, choice]
+
+    def random_members(self, members):
+        """Returns a uniformly drawn index of a True value in every row of members"""
+        keys = self.rng.random(members.shape)
+        keys[~members] = -1
+        return np.argmax(keys, axis=1)
+
+    def close_knowledge(self, g):
+        """Completes the knowledge of the crewmates in games g: who knows all crewmates knows the impostors,
+        and who knows all impostors knows the crewmates"""
+        known_imp = self.known_imp[g]
+        known_crew = self.known_crew[g]
+
+        knows_all_crew = (self.num_agents - known_crew.sum(2)) <= self.num_imp
+        known_imp |= knows_all_crew[:, :, None] & ~known_crew
+        knows_all_imp = known_imp.sum(2) >= self.num_imp
+        known_crew |= knows_all_imp[:, :, None] & ~known_imp
+
+        self.known_imp[g] = known_imp
+        self.known_crew[g] = known_crew
+
+    def check_game_over(self, g, not_yet_removed=None):
+        """Ends the games g that are over, as Controller.check_game_over. not_yet_removed holds agents that are
+        already killed, but still count as alive, as the controller removes them one at a time"""
+        running = self.outcome[g] < 0
+        g = g[running]
+        alive = self.alive[g]
+        if not_yet_removed is not None:
+            alive = alive | not_yet_removed[running]
+
+        num_imps = alive[:, self.num_crew:].sum(1)
+        num_crew = alive[:, :self.num_crew].sum(1)
+        tasks_left = (alive[:, :self.num_crew] & (self.tasks_taken[g] < self.num_tasks)).any(1)
+
+        outcome = np.full(len(g), -1)
+        outcome[~tasks_left] = Outcome.CREW_TASKS
+        outcome[num_imps >= num_crew] = Outcome.IMPOSTORS
+        outcome[num_imps == 0] = Outcome.CREW_VOTE
+        self.outcome[g] = outcome
+
+    def act(self, g):
+        n, C, A = len(g), self.num_crew, self.num_agents
+        rows = np.arange(n)
+        self.rounds[g] += 1
+        self.prev_room[g] = self.room[g]
+
+        # The impostors go first, one after another, as a kill removes the crewmate from the map at once
+        victims = np.full((n, self.num_imp), -1)
+        for j in range(self.num_imp):
+            a = C + j
+            alive = self.alive[g, a]
+            ready = alive & (self.cooldown[g, j] == 0)
+            self.cooldown[g[alive & ~ready], j] -= 1
+
+            in_room = self.alive[g] & (self.room[g] == self.room[g, a][:, None])
+            num_others = in_room.sum(1) - 1
+            attempts = ready & (num_others > 0) & (self.rng.random(n) < 1 - num_others / A)
+            present_crew = in_room & self.is_crew
+            kills = attempts & present_crew.any(1)
+
+            # The impostor moves unless it attempts to kill, even if there turns out to be no crewmate to kill
+            moves = alive & ~attempts & (self.rng.random(n) > self.stat_thres)
+            self.room[g[moves], a] = self.random_neighbours(self.room[g[moves], a])
+
+            killed = self.random_members(present_crew[kills])
+            kill_games = g[kills]
+            kill_rooms = self.room[kill_games, a]
+            self.alive[kill_games, killed] = False
+            self.kill_events[kill_games, kill_rooms] = a
+            self.corpses[kill_games, kill_rooms] = killed
+            self.cooldown[kill_games, j] = self.cooldown_length
+            self.kills[kill_games] += 1
+            victims[rows[kills], j] = killed
+
+        # The game is checked after each kill, with the later victims still counting as alive
+        not_yet_removed = np.zeros((n, A), dtype=bool)
+        has_victim = victims >= 0
+        not_yet_removed[np.nonzero(has_victim)[0], victims[has_victim]] = True
+        for j in range(self.num_imp):
+            killed = has_victim[:, j]
+            not_yet_removed[rows[killed], victims[killed, j]] = False
+            self.check_game_over(g[killed], not_yet_removed[killed])
+
+        # Then the living crewmates complete their goal, or move toward it, or move randomly if they have none left
+        alive = self.alive[g, :C]
+        goal = self.goal[g]
+        room = self.room[g, :C]
+        goal_room = np.where(goal >= 0, self.task_rooms[goal], -1)
+
+        completes = alive & (goal >= 0) & (room == goal_room)
+        visual = completes & np.take_along_axis(self.task_visual[g], np.maximum(goal, 0), axis=1)
+        task_games, crewmates = np.nonzero(visual)
+        np.maximum.at(self.visual_task_events, (g[task_games], room[task_games, crewmates]), crewmates)
+        goal[completes] = -1
+
+        needs_goal = alive & ~completes & (goal < 0)
+        tasks_taken = self.tasks_taken[g]
+        takes = needs_goal & (tasks_taken < self.num_tasks)
+        task_games, crewmates = np.nonzero(takes)
+        goal[takes] = self.task_order[g[task_games], crewmates, tasks_taken[takes]]
+        tasks_taken[takes] += 1
+
+        wanders = needs_goal & ~takes
+        room[wanders] = self.random_neighbours(room[wanders])
+
+        goal_room = np.where(goal >= 0, self.task_rooms[goal], -1)
+        moves = alive & ~completes & (goal >= 0) & (room != goal_room)
+        room[moves] = self.nav[room[moves], goal_room[moves]]
+
+        self.goal[g] = goal
+        self.tasks_taken[g] = tasks_taken
+        self.room[g, :C] = room
+        self.phase[g] = Phase.OBSERVE.value
+
+    def observe(self, g):
+        n, C = len(g), self.num_crew
+        rows = np.arange(n)[:, None]
+        alive = self.alive[g, :C]
+        room = self.room[g, :C]
+        prev_room = self.prev_room[g, :C]
+
+        # The events in the current room come after those in the previous room, and the last one is seen
+        def last_event(events):
+            return np.where(events[rows, room] >= 0, events[rows, room], events[rows, prev_room])
+
+        kill_seen = last_event(self.kill_events[g])
+        task_seen = last_event(self.visual_task_events[g])
+        corpse_seen = last_event(self.corpses[g])
+
+        occupancy = np.zeros((n, self.num_rooms), dtype=np.int64)
+        np.add.at(occupancy, (np.repeat(np.arange(n), self.num_agents)[self.alive[g].ravel()],
+                              self.room[g][self.alive[g]]), 1)
+        company = occupancy[rows, room] > 1
+
+        # Witnessing a kill reveals the impostor, witnessing a visual task clears and earns the trust of a crewmate
+        catches = alive & company & (kill_seen >= 0)
+        games, crewmates = np.nonzero(catches)
+        self.known_imp[g[games], crewmates, kill_seen[catches]] = True
+
+        clears = alive & company & (kill_seen < 0) & (task_seen >= 0)
+        games, crewmates = np.nonzero(clears)
+        self.known_crew[g[games], crewmates, task_seen[clears]] = True
+        self.trusted[g[games], crewmates, task_seen[clears]] = True
+
+        # Every living crewmate learns that a corpse that is found was a crewmate
+        found = alive & (corpse_seen >= 0)
+        found_corpses = np.zeros((n, self.num_agents), dtype=bool)
+        found_corpses[np.nonzero(found)[0], corpse_seen[found]] = True
+        self.known_crew[g] |= alive[:, :, None] & found_corpses[:, None, :]
+        self.close_knowledge(g)
+
+        self.kill_events[g] = -1
+        self.visual_task_events[g] = -1
+        self.phase[g] = np.where(found.any(1), Phase.DISCUSS.value, Phase.ACT.value)
+
+    def discuss(self, g):
+        C = self.num_crew
+        self.corpses[g] = -1
+        self.room[g] = self.room_meeting
+        self.prev_room[g] = self.room_meeting
+        self.cooldown[g] = self.cooldown_length
+        self.meetings[g] += 1
+
+        # The living crewmates announce what they know, after which every living crewmate
+        # takes over the last announcement of every other crewmate it trusts
+        alive = self.alive[g, :C]
+        self.has_announced[g] |= alive
+        self.announced_imp[g] = np.where(alive[:, :, None], self.known_imp[g], self.announced_imp[g])
+        self.announced_crew[g] = np.where(alive[:, :, None], self.known_crew[g], self.announced_crew[g])
+
+        uses = self.trusted[g] & self.has_announced[g][:, None, :] & alive[:, :, None] & ~np.eye(C, dtype=bool)
+        weights = uses.astype(np.uint8)
+        self.known_imp[g] |= np.matmul(weights, self.announced_imp[g].astype(np.uint8)) > 0
+        self.known_crew[g] |= np.matmul(weights, self.announced_crew[g].astype(np.uint8)) > 0
+        self.trust_relations[g] |= uses
+        self.close_knowledge(g)
+
+        self.phase[g] = Phase.VOTE.value
+
+    def vote(self, g):
+        n, C, A = len(g), self.num_crew, self.num_agents
+        alive = self.alive[g]
+        known_imp = self.known_imp[g] & alive[:, None, :]
+        suspects = ~self.known_crew[g] & alive[:, None, :]
+
+        # The impostors vote for the living crewmate that suspects the fewest living agents
+        num_suspects = np.full((n, A), 2 ** 30)
+        num_suspects[:, :C] = np.where(alive[:, :C], suspects.sum(2), 2 ** 30)
+        num_suspects[:, C:] = np.where(alive[:, C:], 999999, 2 ** 30)
+        target = np.argmin(num_suspects, axis=1)
+
+        # A crewmate votes for the last impostor it knows, or else for a random suspect, or passes, which is more
+        # likely the more agents it suspects
+        knows_imp = known_imp.any(2)
+        last_known_imp = A - 1 - np.argmax(known_imp[:, :, ::-1], axis=2)
+        random_suspect = self.random_members(suspects.reshape(n * C, A)).reshape(n, C)
+        passes = self.rng.random((n, C)) < suspects.sum(2) / A * 0.5
+        crew_votes = np.where(knows_imp, last_known_imp, np.where(passes, -1, random_suspect))
+
+        votes = np.concatenate([crew_votes, np.repeat(target[:, None], self.num_imp, axis=1)], axis=1)
+        tally = np.zeros((n, A + 1), dtype=np.int64)
+        voters = np.nonzero(alive)
+        np.add.at(tally, (voters[0], votes[voters] + 1), 1)
+
+        most = tally.max(1)
+        top = np.argmax(tally, axis=1)
+        voted_off = ((tally == most[:, None]).sum(1) == 1) & (top > 0)
+        self.alive[g[voted_off], top[voted_off] - 1] = False
+        self.voted_off[g[voted_off]] += 1
+
+        self.phase[g] = Phase.CHECK.value
+
+    def check(self, g):
+        self.check_game_over(g)
+        self.phase[g] = Phase.ACT.value
+
+
+def lockstep_run(config, game_map, num_steps, seed=None, chunk_size=None, first_run=0):
+    """Plays num_steps games in chunks of chunk_size games at once, and returns their stats table"""
+    if chunk_size is None:
+        chunk_size = 10000
+
+    rng = np.random.default_rng(seed)
+    tables = []
+    for start in range(0, num_steps, chunk_size):
+        simulation = LockstepSimulation(config, game_map, min(chunk_size, num_steps - start), rng.integers(2 ** 32),
+                                        first_run + start)
+        tables.append(simulation.run())
+    return np.concatenate(tables)
+
+
+def lockstep_headless_run(config, num_steps, seed, chunk_size=None, file_name=None, first_run=0):
+    """Plays num_steps games in lockstep, and saves their stats table as a results store"""
+    from logger import Logger
+    from map import FileMap, SIMPLE_SKELD_FILE
+
+    logger = Logger.get_instance()
+    logger.add_run_info("num_sim_runs", num_steps)
+    logger.add_run_info("first_run", first_run)
+
+    game_map = FileMap(config.get("map", SIMPLE_SKELD_FILE), config["num_crew"] + config["num_imp"])
+    save_game_stats(file_name, logger.run_info, lockstep_run(config, game_map, num_steps, seed, chunk_size, first_run))
+
+
+def compare_stats(expected, actual, max_z=4.0):
+    """Compares the win rates and the means of the counters of two stats tables. Returns the rows of the
+    comparison, each with the z-score of the difference, and whether all z-scores are below max_z"""
+    def proportion(table, outcome):
+        return (table["outcome"] == outcome).astype(float)
+
+    rows = []
+    metrics = [(outcome.name, lambda t, o=outcome: proportion(t, o)) for outcome in Outcome] + \
+              [(name, lambda t, name=name: t[name].astype(float))
+               for name in ("rounds", "meetings", "kills", "voted_off", "trusts")]
+    for name, values in metrics:
+        e, a = values(expected), values(actual)
+        se = np.sqrt(e.var(ddof=1) / len(e) + a.var(ddof=1) / len(a))
+        z = abs(e.mean() - a.mean()) / se if se > 0 else 0.0
+        rows.append((name, e.mean(), a.mean(), z))
+
+    return rows, all(z < max_z for *_, z in rows)
+
+
+def validate_lockstep(config, num_games, seed=0, lockstep_factor=10):
+    """Plays num_games games with the Controller and lockstep_factor times as many in lockstep,
+    and compares their statistics"""
+    from batch import create_simulation
+    from logger import Logger
+    from map import FileMap, SIMPLE_SKELD_FILE
+
+    logger = Logger.get_instance()
+    logger.set_headless_mode(True)
+    logger.disable_logging()
+
+    start = time.perf_counter()
+    km, controller = create_simulation(config, seed)
+    for i in range(num_games):
+        controller.reset(i)
+        controller.run_to_end()
+    expected = controller.take_game_stats()
+    controller_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    game_map = FileMap(config.get("map", SIMPLE_SKELD_FILE), config["num_crew"] + config["num_imp"])
+    actual = lockstep_run(config, game_map, num_games * lockstep_factor, seed)
+    lockstep_time = time.perf_counter() - start
+
+    rows, valid = compare_stats(expected, actual)
+    print(f"{'':>12} {'controller':>12} {'lockstep':>12} {'z':>6}")
+    for name, e, a, z in rows:
+        print(f"{name:>12} {e:>12.4f} {a:>12.4f} {z:>6.2f}")
+    print(f"Controller: {num_games / controller_time:.0f} games/s, "
+          f"lockstep: {num_games * lockstep_factor / lockstep_time:.0f} games/s")
+    print("Statistics agree" if valid else "Statistics differ")
+    return valid
+
+
+if __name__ == "__main__":
+
+    config = {
+        "num_crew": 8,
+        "num_imp": 2,
+        "num_tasks": 10,
+        "num_visuals": 4,
+        "cooldown": 5,
+        "stat_thres": 0.5,
+        "engine": "bitset"
+    }
+    num_games = 2000
+    seed = 0
+
+    for i, arg in enumerate(sys.argv):
+        if arg == "--games":
+            num_games = int(sys.argv[i + 1])
+        elif arg == "--seed":
+            seed = int(sys.argv[i + 1])
+        elif arg == "--num_crew":
+            config["num_crew"] = int(sys.argv[i + 1])
+        elif arg == "--num_imp":
+            config["num_imp"] = int(sys.argv[i + 1])
+        elif arg == "--num_tasks":
+            config["num_tasks"] = int(sys.argv[i + 1])
+        elif arg == "--visuals":
+            config["num_visuals"] = int(sys.argv[i + 1])
+        elif arg == "--cooldown":
+            config["cooldown"] = int(sys.argv[i + 1])
+        elif arg == "--stat_thres":
+            config["stat_thres"] = float(sys.argv[i + 1])
+
+    exit(0 if validate_lockstep(config, num_games, seed) else 1)
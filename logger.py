@@ -1,10 +1,184 @@
 from datetime import datetime
-import pickle
+from enum import IntEnum
+from queue import Queue
+from threading import Thread
+import json
+import struct
 """
     Singleton logger class for ease of access throughout the program.
+
+    Everything that is logged is stored as a structured event: the run and step it happened in, its phase, its type,
+    up to two agent ids and an optional text payload. The events are saved in a compact binary format, which
+    util/log_reader.py loads without any string parsing. The text form of an event is only created when it is printed,
+    and its payload is only created when the event is kept or printed, so call sites can pass the object that
+    describes it, or a function that creates it. Whole categories of events can be disabled in headless runs.
+    A long run streams its events to the log file with open_log, which writes them in chunks of buffer_size events.
 """
 
 
+class LogEvent(IntEnum):
+    MESSAGE = 0
+    RUN = 1
+    PHASE = 2
+    GOAL_COMPLETED = 3
+    GOAL_SET = 4
+    WITNESS_TASK = 5
+    TRUST = 6
+    SUSPECT = 7
+    CREW_VOTE = 8
+    KILL = 9
+    ANNOUNCE = 10
+    IMP_VOTE = 11
+    TIE = 12
+    PASS = 13
+    VOTED_OFF = 14
+    CREW_WIN_VOTE = 15
+    CREW_WIN_TASKS = 16
+    IMP_WIN = 17
+    REMOVE_NODES = 18
+
+
+# The text of each event type, formatted with the run, the agent ids a and b and the payload p of the event
+LOG_EVENT_TEXT = {
+    LogEvent.MESSAGE: "{p}",
+    LogEvent.RUN: "Run: {run}",
+    LogEvent.PHASE: "Phase.{p}",
+    LogEvent.GOAL_COMPLETED: "Crewmate {a} completed their goal: {p}",
+    LogEvent.GOAL_SET: "Crewmate {a} set as goal: {p}",
+    LogEvent.WITNESS_TASK: "{a} witnessed task {b}",
+    LogEvent.TRUST: "{a} trusts {b} On formula: {p}",
+    LogEvent.SUSPECT: "Crewmate {a} suspects {b}",
+    LogEvent.CREW_VOTE: "Crewmate {a} votes for {b}\n",
+    LogEvent.KILL: "Impostor {a} kills {b}!",
+    LogEvent.ANNOUNCE: "Announced: {p}",
+    LogEvent.IMP_VOTE: "Impostor {a} votes for {b}",
+    LogEvent.TIE: "A tie: No agent was voted off.",
+    LogEvent.PASS: "Most agents pass: No agent was voted off.",
+    LogEvent.VOTED_OFF: "Agent {a} received the most votes and is voted off.",
+    LogEvent.CREW_WIN_VOTE: "Crewmates win!",
+    LogEvent.CREW_WIN_TASKS: "Crewmates win! (tasks)",
+    LogEvent.IMP_WIN: "Impostors win!",
+    LogEvent.REMOVE_NODES: "Removing nodes: {p}",
+}
+
+# The categories of events that can be disabled. The other events describe the course and outcome of each run,
+# which the analysis of a log depends on, so they are always kept
+LOG_CATEGORIES = {
+    "goals": (LogEvent.GOAL_SET, LogEvent.GOAL_COMPLETED),
+    "observations": (LogEvent.WITNESS_TASK,),
+    "trust": (LogEvent.TRUST,),
+    "announcements": (LogEvent.ANNOUNCE,),
+    "votes": (LogEvent.SUSPECT, LogEvent.CREW_VOTE, LogEvent.IMP_VOTE),
+    "knowledge": (LogEvent.REMOVE_NODES,),
+}
+
+# Log file layout: the magic bytes, followed by blocks. A header block holds the JSON header of a section, a chunk
+# block holds a number of events of a section: their fixed size records, followed by their utf-8 payloads.
+# The footer block is written when the log is closed, so a log without footer was cut off during the run.
+# Section 0 holds the run info of the file, a sweep has a section for every config after it.
+LOG_FILE_MAGIC = b"AMONGEV2"
+LOG_FILE_END = b"AMONGEND"
+HEADER_BLOCK = b"H"
+CHUNK_BLOCK = b"C"
+FOOTER_BLOCK = b"F"
+# section, header length
+HEADER_INFO = struct.Struct("<II")
+# section, number of events, payload length
+CHUNK_INFO = struct.Struct("<III")
+# number of events in the file
+FOOTER_INFO = struct.Struct("<Q")
+# run, step, phase, event type, agent a, agent b, payload length
+EVENT_RECORD = struct.Struct("<IIBBhhI")
+
+
+def event_text(event):
+    """Returns the text of an event tuple (run, step, phase, event type, a, b, payload)"""
+    run, step, phase, event_type, a, b, payload = event
+    return LOG_EVENT_TEXT[LogEvent(event_type)].format(run=run, a=a, b=b, p=payload)
+
+
+class LogWriter:
+    """
+        Writes a log file incrementally. Every chunk of events is written and flushed to disk when it is given,
+        so the events do not have to be kept in memory, and a crash only loses the events that were not given yet.
+        With background set, the chunks are packed and written by a separate thread. At most queue_size chunks
+        wait for it, so a slow disk holds up the simulation instead of filling the memory. If the thread fails to
+        write, it drops the chunks that follow, and the error is raised by the next write or by close.
+    """
+
+    def __init__(self, file_name, background=False, queue_size=4):
+        self.f = open(file_name, "wb")
+        self.f.write(LOG_FILE_MAGIC)
+        self.num_events = 0
+
+        self.queue = None
+        self.thread = None
+        # The error the background thread failed with
+        self.error = None
+        if background:
+            self.queue = Queue(queue_size)
+            self.thread = Thread(target=self.__write_queued, daemon=True)
+            self.thread.start()
+
+    def write_header(self, section, header):
+        self.__put(self.__write_header, section, header)
+
+    def write_events(self, section, events):
+        if events:
+            self.num_events += len(events)
+            self.__put(self.__write_chunk, section, events)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        try:
+            self.__raise_error()
+            self.f.write(FOOTER_BLOCK + FOOTER_INFO.pack(self.num_events) + LOG_FILE_END)
+        finally:
+            self.f.close()
+
+    def __raise_error(self):
+        if self.error is not None:
+            raise IOError(f"Writing the log file {self.f.name} failed") from self.error
+
+    def __put(self, write, *args):
+        self.__raise_error()
+        if self.thread is not None:
+            self.queue.put((write, args))
+        else:
+            write(*args)
+
+    def __write_queued(self):
+        # After an error, the queue is still emptied, so that the simulation is never blocked by a full queue
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                write, args = item
+                try:
+                    write(*args)
+                except Exception as e:
+                    self.error = e
+
+    def __write_header(self, section, header):
+        header = json.dumps(header).encode("utf-8")
+        self.f.write(HEADER_BLOCK + HEADER_INFO.pack(section, len(header)) + header)
+        self.f.flush()
+
+    def __write_chunk(self, section, events):
+        payloads = [payload.encode("utf-8") for *_, payload in events]
+        payload_length = sum(len(payload) for payload in payloads)
+
+        self.f.write(CHUNK_BLOCK + CHUNK_INFO.pack(section, len(events), payload_length))
+        self.f.write(b"".join(EVENT_RECORD.pack(*event[:-1], len(payload)) for event, payload in zip(events, payloads)))
+        self.f.write(b"".join(payloads))
+        self.f.flush()
+
+
 class Logger:
     PRINT_VISUAL    = 0b1
     PRINT_HEADLESS  = 0b10
@@ -29,17 +203,62 @@ class Logger:
             Logger.__instance = self
 
         self.run_info = {}
-        self.messages = []
+        self.events = []
         self.headless_mode = False
+        self.print_level = Logger.PRINT_VISUAL
+        self.disabled_events = set()
+
+        # The writer of the log file that is streamed to, and the number of events that are kept before writing them
+        self.writer = None
+        self.buffer_size = 65536
+
+        # The run, step and phase that new events are recorded in
+        self.run = 0
+        self.step = 0
+        self.phase = 0
 
     def set_headless_mode(self, val):
         self.headless_mode = val
+        self.print_level = Logger.PRINT_HEADLESS if val else Logger.PRINT_VISUAL
+
+    def disable_log_categories(self, categories):
+        """Stops logging the events of the given categories, see LOG_CATEGORIES"""
+        for category in categories:
+            self.disabled_events.update(LOG_CATEGORIES[category])
+
+    def disable_logging(self):
+        """Stops logging any event"""
+        self.disabled_events = set(LogEvent)
+
+    def start_run(self, run):
+        self.run = run
+        self.step = 0
+        self.phase = 0
+        self.log_event(LogEvent.RUN, Logger.LOG)
+
+    def set_step(self, step, phase):
+        self.step = step
+        self.phase = phase
 
     def log(self, msg, log_level):
+        self.log_event(LogEvent.MESSAGE, log_level, payload=msg)
+
+    def log_event(self, event_type, log_level, a=-1, b=-1, payload=""):
+        """Logs an event. The payload is a string, an object of which the string is the payload,
+        or a function that returns the payload, which are only converted if the event is kept or printed"""
+        if event_type in self.disabled_events or not log_level & (Logger.LOG | self.print_level):
+            return
+
+        if type(payload) is not str:
+            payload = payload() if callable(payload) else str(payload)
+        event = (self.run, self.step, self.phase, event_type, a, b, payload)
 
         if log_level & Logger.LOG:
-            self.messages.append(msg)
-        if (log_level & Logger.PRINT_VISUAL and not self.headless_mode) or (log_level & Logger.PRINT_HEADLESS and self.headless_mode):
+            self.events.append(event)
+            if self.writer is not None and len(self.events) >= self.buffer_size:
+                self.flush()
+        if log_level & self.print_level:
+            msg = event_text(event)
             if log_level & Logger.WARN:
                 print(f"\033[93m{msg}\033[0m")
             elif log_level & Logger.ERR:
@@ -52,17 +271,51 @@ class Logger:
     def add_run_info(self, key, value):
         self.run_info[key] = value
 
+    def get_events(self):
+        return self.events
+
     def get_logs(self):
-        return self.messages
+        """Returns the logged events as text"""
+        return [event_text(event) for event in self.events]
 
-    def save_logs(self, file_name=None):
+    def clear_logs(self):
+        self.events = []
 
+    @staticmethod
+    def get_log_file_name(file_name=None, extension=".amongus"):
         if file_name is None:
-            file_name = datetime.now().strftime("%y_%m_%d__%H-%M.amongus")
-        elif not file_name.endswith(".amongus"):
-            file_name = file_name + ".amongus"
+            file_name = datetime.now().strftime("%y_%m_%d__%H-%M") + extension
+        elif not file_name.endswith(extension):
+            file_name = file_name + extension
+        return file_name
 
-        with open(file_name, "wb") as f:
-            pickle.dump({"run_info": self.run_info, "logs": self.messages}, f)
+    def open_log(self, file_name=None, buffer_size=None, background=False):
+        """Starts streaming the events into a log file, with the run info as it is now. Must be closed with close_log"""
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
 
+        self.writer = LogWriter(Logger.get_log_file_name(file_name), background)
+        self.writer.write_header(0, {"run_info": self.run_info})
 
+    def log_events(self, events):
+        """Adds events that were logged elsewhere, such as in a worker process"""
+        self.events.extend(events)
+        if self.writer is not None and len(self.events) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the kept events to the log file that is streamed to"""
+        self.writer.write_events(0, self.events)
+        self.events = []
+
+    def close_log(self):
+        self.flush()
+        self.writer.close()
+        self.writer = None
+
+    def save_logs(self, file_name=None):
+        """Saves all kept events into a log file at once"""
+        writer = LogWriter(Logger.get_log_file_name(file_name))
+        writer.write_header(0, {"run_info": self.run_info})
+        writer.write_events(0, self.events)
+        writer.close()
@@ -1,13 +1,16 @@
 import pygame
+import random
 import sys
-from map import SimpleSkeld
-from controller import Controller
-from logger import Logger
+from batch import create_simulation, parallel_headless_run, sweep_headless_run, validate_config, \
+    create_sweep_configs, parse_grid_arg, load_sweep_configs
+from logger import Logger, LOG_CATEGORIES
+from game_stats import save_game_stats
+from lockstep import lockstep_headless_run
+from map import SIMPLE_SKELD_FILE
 from tqdm import tqdm
 
 from gui.tabmanager import TabManager
-from pane import SimpleSkeldPane, MenuPane, InfoPane, KripkePane
-from mlsolver.model import AmongUsTwoImp, AmongUsOneImp
+from pane import FileMapPane, MenuPane, InfoPane, KripkePane
 from util.util import Message
 
 
@@ -20,7 +23,7 @@ def visual_run(controller, km, num_imp):
     # The tab manager is for drawing utility, and each pane something to be drawn on the screen
     tm = TabManager()
 
-    ssp = SimpleSkeldPane(controller, num_imp, screen, 0, 0)
+    ssp = FileMapPane(controller, num_imp, screen, 0, 0)
     mp = MenuPane(km, tm, controller, screen, 768, 0, 256, 1024, (255, 255, 255))
     ip = InfoPane(controller, screen, 0, 600, 1024, 256, (64, 64, 64))
 
@@ -86,21 +89,30 @@ def visual_run(controller, km, num_imp):
         clock.tick(30)
 
 
-def headless_run(controller, num_steps, file_name=None):
+def headless_run(controller, num_steps, file_name=None, first_run=0, log_buffer=None, log_thread=False,
+                 stats_only=False):
     logger = Logger.get_instance()
     logger.add_run_info("num_sim_runs", num_steps)
+    logger.add_run_info("first_run", first_run)
 
-    for i in tqdm(range(num_steps)):
-        logger.log(f"Run: {i}", Logger.LOG)
-        controller.receive(Message(None, "run_to_end", None))
+    # The events are written to the log file while running, so that memory use does not grow with num_steps
+    if not stats_only:
+        logger.open_log(file_name, log_buffer, log_thread)
 
-    logger.save_logs(file_name)
+    for i in tqdm(range(first_run, first_run + num_steps)):
+        logger.start_run(i)
+        controller.receive(Message(None, "run_to_end", {"game_index": i}))
+
+    if stats_only:
+        save_game_stats(file_name, logger.run_info, controller.take_game_stats())
+    else:
+        logger.close_log()
 
 
 if __name__ == "__main__":
 
     num_crew = 8
-    num_imp = 2 # Currently one and two are accepted values
+    num_imp = 2
 
     num_tasks = 10
     num_visuals = 4
@@ -112,6 +124,33 @@ if __name__ == "__main__":
     cooldown = 5
     stationary_threshold = 0.5
 
+    engine = "subset"
+
+    # The map file, see map.load_map_definition
+    map_file_name = SIMPLE_SKELD_FILE
+
+    num_workers = 1
+
+    # Without a seed, one is drawn at random. It is stored in the run info, so that runs can be replayed
+    seed = None
+    first_run = 0
+
+    # A sweep runs headless for every combination of the grid values and the configs in the configs file
+    sweep = len(sys.argv) > 1 and sys.argv[1] == "sweep"
+    grid_args = []
+    configs_file_name = None
+    chunk_size = None
+
+    # The number of events kept in memory before they are written to the log file, and whether a thread writes them
+    log_buffer = None
+    log_thread = False
+    # Categories of events that are not logged, see logger.LOG_CATEGORIES
+    disabled_log = []
+    # Only keep the summary stats of each game, instead of logging
+    stats_only = False
+    # Play all games at once with the vectorized simulation of lockstep.py, which only keeps the summary stats
+    lockstep = False
+
     # Can be expanded easily to allow for more customization from a terminal run
     for i, arg in enumerate(sys.argv):
         if arg == "--headless":
@@ -132,38 +171,102 @@ if __name__ == "__main__":
             cooldown = int(sys.argv[i + 1])
         elif arg == "--stat_thres":
             stationary_threshold = float(sys.argv[i + 1])
-
-    if num_visuals > num_tasks:
-        print("Visuals cannot be set higher than the number of tasks available")
+        elif arg == "--engine":
+            engine = sys.argv[i + 1]
+        elif arg == "--map":
+            map_file_name = sys.argv[i + 1]
+        elif arg == "--workers":
+            num_workers = int(sys.argv[i + 1])
+        elif arg == "--grid":
+            grid_args.append(sys.argv[i + 1])
+        elif arg == "--configs":
+            configs_file_name = sys.argv[i + 1]
+        elif arg == "--chunk_size":
+            chunk_size = int(sys.argv[i + 1])
+        elif arg == "--log_buffer":
+            log_buffer = int(sys.argv[i + 1])
+        elif arg == "--log_thread":
+            log_thread = True
+        elif arg == "--no_log":
+            disabled_log = sys.argv[i + 1].split(",")
+        elif arg == "--stats_only":
+            stats_only = True
+        elif arg == "--lockstep":
+            lockstep = True
+        elif arg == "--seed":
+            seed = int(sys.argv[i + 1])
+        elif arg == "--first_run":
+            first_run = int(sys.argv[i + 1])
+
+    if num_workers < 1:
+        print("At least one worker is required.")
         exit(1)
-
-    if not 0 < num_imp <= 2:
-        print("One or two impostors are supported.")
+    if any(category not in LOG_CATEGORIES for category in disabled_log):
+        print(f"Log categories that can be disabled are: {', '.join(LOG_CATEGORIES)}")
+        exit(1)
+    if lockstep and (sweep or not headless or not stats_only):
+        print("Lockstep runs require --headless and --stats_only, and cannot be sweeps.")
         exit(1)
 
-    # The map we want to use
-    ss = SimpleSkeld(num_crew + num_imp)
-
-    if num_imp == 1:
-        km = AmongUsOneImp(num_crew + num_imp)
+    config = {
+        "num_crew": num_crew,
+        "num_imp": num_imp,
+        "num_tasks": num_tasks,
+        "num_visuals": num_visuals,
+        "cooldown": cooldown,
+        "stat_thres": stationary_threshold,
+        "engine": engine,
+        "map": map_file_name
+    }
+
+    if sweep:
+        try:
+            grid = dict(parse_grid_arg(config, arg) for arg in grid_args)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        overrides = load_sweep_configs(configs_file_name) if configs_file_name else None
+        configs = create_sweep_configs(config, overrides, grid)
     else:
-        km = AmongUsTwoImp(num_crew + num_imp)
+        configs = [config]
+
+    for c in configs:
+        error = validate_config(c)
+        if error is not None:
+            print(error)
+            exit(1)
 
-    # The controller controls the simulation flow
-    controller = Controller(km, ss, num_crew, num_imp, num_tasks, num_visuals, cooldown, stationary_threshold)
+    if seed is None:
+        seed = random.randrange(2 ** 32)
 
     logger = Logger.get_instance()
-    logger.set_headless_mode(headless)
+    logger.set_headless_mode(headless or sweep)
+    logger.disable_log_categories(disabled_log)
+    if stats_only:
+        logger.disable_logging()
 
     # Dump run statistics into file so that it is easy to find back later during analysis
-    logger.add_run_info("num_crew", num_crew)
-    logger.add_run_info("num_imp", num_imp)
-    logger.add_run_info("num_tasks", num_tasks)
-    logger.add_run_info("num_visuals", num_visuals)
-    logger.add_run_info("cooldown", cooldown)
-    logger.add_run_info("stat_thres", stationary_threshold)
-
-    if not headless:
+    for key, value in config.items():
+        logger.add_run_info(key, value)
+    logger.add_run_info("seed", seed)
+    logger.add_run_info("disabled_log", disabled_log)
+    logger.add_run_info("stats_only", stats_only)
+    logger.add_run_info("lockstep", lockstep)
+
+    if sweep:
+        sweep_headless_run(configs, num_steps_headless, num_workers, seed, chunk_size, log_file_name, log_thread,
+                           stats_only, first_run)
+    elif not headless:
+        km, controller = create_simulation(config, seed)
+        if controller.game_map.image is None or None in controller.game_map.room_coords:
+            print("The map has no image and room coords to draw it with, it can only be run headless.")
+            exit(1)
         visual_run(controller, km, num_imp)
+    elif lockstep:
+        lockstep_headless_run(config, num_steps_headless, seed, chunk_size, log_file_name, first_run)
+    elif num_workers > 1:
+        parallel_headless_run(config, num_steps_headless, num_workers, seed, chunk_size, log_file_name, log_buffer,
+                              log_thread, stats_only, first_run)
     else:
-        headless_run(controller, num_steps_headless, log_file_name)
+        km, controller = create_simulation(config, seed)
+        headless_run(controller, num_steps_headless, log_file_name, first_run, log_buffer, log_thread, stats_only)
@@ -1,10 +1,26 @@
+import hashlib
+import json
+import os
 import random
+import numpy as np
 
 from abc import ABC
 from collections import deque
 from task import Task
 from room_events import EventType, RoomEvent
 
+MAPS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps")
+SIMPLE_SKELD_FILE = os.path.join(MAPS_FOLDER, "simple_skeld.json")
+# The compiled navigation tables of map files, stored by the hash of the file in this folder next to the file
+NAV_CACHE_FOLDER = ".navcache"
+
+# The navigation tables of every room layout, keyed by its adjacency matrix. They are computed once and shared by
+# all maps with that layout, including those of worker processes that are forked after the first map was created
+nav_tables = {}
+# The definitions of the map files that were loaded, keyed by the hash of the file
+map_definitions = {}
+
+
 class Map(ABC):
 
     def __init__(self, room_nums, room_names, room_adjacent, room_start, room_meeting, tasks, num_agents):
@@ -16,43 +32,86 @@ class Map(ABC):
         self.tasks = tasks
         self.num_agents = num_agents
 
-        self.rooms = []
+        # The occupants of each room as a bitmask of agent ids, their number, and the room of each agent,
+        # which is -1 for an agent that was removed from the map
+        self.room_masks = []
+        self.room_counts = []
+        self.agent_rooms = []
+        # The agent of the latest event of each type in each room during this step, or -1, and the rooms that
+        # have events, which are the only ones that need to be reset after the step
         self.room_events = []
+        self.event_rooms = []
         self.corpses = []
 
         self.map_reset()
 
-        # Used for navigation
-        self.nav = self.create_nav()
+        # Used for navigation: the adjacent rooms of every room, and for every pair of rooms the first room on
+        # a shortest path between them and the length of that path
+        self.neighbours, self.nav, self.distances = Map.get_nav_tables(room_adjacent)
 
     def map_reset(self):
         # Keeps track of room occupancy
-        self.rooms = [[0] * self.num_agents for _ in range(self.room_nums)]
-        self.rooms[self.room_start] = [1] * self.num_agents
+        self.room_masks = [0] * self.room_nums
+        self.room_counts = [0] * self.room_nums
+        self.agent_rooms = [-1] * self.num_agents
+        for agent_id in range(self.num_agents):
+            self.place_agent(agent_id, self.room_start)
 
         # Keeps track of what events have happened in a room
-        self.room_events = [[] for _ in range(self.room_nums)]
+        self.room_events = [[-1] * len(EventType) for _ in range(self.room_nums)]
+        self.event_rooms = []
 
         # Keeps track of corpses
         self.corpses = [[] for _ in range(self.room_nums)]
 
+    def place_agent(self, agent_id, room):
+        """Puts an agent in a room, moving it out of the room it was in"""
+        old_room = self.agent_rooms[agent_id]
+        if old_room != -1:
+            self.room_masks[old_room] &= ~(1 << agent_id)
+            self.room_counts[old_room] -= 1
+
+        self.room_masks[room] |= 1 << agent_id
+        self.room_counts[room] += 1
+        self.agent_rooms[agent_id] = room
+
+    def remove_agent_id(self, agent_id):
+        room = self.agent_rooms[agent_id]
+        if room != -1:
+            self.room_masks[room] &= ~(1 << agent_id)
+            self.room_counts[room] -= 1
+            self.agent_rooms[agent_id] = -1
+
+    def get_agent_room(self, agent_id):
+        return self.agent_rooms[agent_id]
+
+    def count_in_room(self, room):
+        return self.room_counts[room]
+
+    def is_in_room(self, agent_id, room):
+        return self.room_masks[room] >> agent_id & 1 == 1
+
+    def agents_in_room(self, room):
+        """Returns the ids of the agents in a room, in increasing order"""
+        agent_ids = []
+        mask = self.room_masks[room]
+        while mask:
+            lowest = mask & -mask
+            agent_ids.append(lowest.bit_length() - 1)
+            mask ^= lowest
+        return agent_ids
+
     def next_toward(self, agent, target):
-        self.rooms[agent.room][agent.agent_id] = 0
         next_room = self.nav[agent.room][target]
-        self.rooms[next_room][agent.agent_id] = 1
+        self.place_agent(agent.agent_id, next_room)
 
         return next_room
 
-    # Not terribly efficient.
     def move_random(self, agent):
-        picked_room = random.randint(0, self.room_nums - 1)
+        """Moves the agent to a random adjacent room, drawn from the random stream of the agent"""
+        picked_room = agent.rng.choice(self.neighbours[agent.room])
 
-        # Grr. I want Do-while
-        while self.room_adjacent[agent.room][picked_room] == 0:
-            picked_room = random.randint(0, self.room_nums - 1)
-
-        self.rooms[agent.room][agent.agent_id] = 0
-        self.rooms[picked_room][agent.agent_id] = 1
+        self.place_agent(agent.agent_id, picked_room)
         return picked_room
 
     def mark_agent_killed(self, agent, voted_off=False):
@@ -62,28 +121,40 @@ class Map(ABC):
             self.corpses[agent.room].append(RoomEvent(EventType.CORPSE, agent.agent_id, "Corpse"))
 
     def remove_agent(self, agent):
-        self.rooms[agent.room][agent.agent_id] = 0
+        self.remove_agent_id(agent.agent_id)
 
     def reset_room_events(self):
-        self.room_events = [[] for _ in range(self.room_nums)]
+        for room in self.event_rooms:
+            self.room_events[room] = [-1] * len(EventType)
+        self.event_rooms = []
 
     def add_room_event(self, room, event):
-        self.room_events[room].append(event)
+        self.room_events[room][event.type.value] = event.agent_id
+        self.event_rooms.append(room)
+
+    def get_latest_event(self, event_type, rooms):
+        """Returns the agent of the latest event of a type in the given rooms, or -1 if there is none.
+        The events of a room count as later than those of the rooms before it, and corpses as the latest events"""
+        latest = -1
+        for room in rooms:
+            if event_type == EventType.CORPSE:
+                agent_id = self.corpses[room][-1].agent_id if self.corpses[room] else -1
+            else:
+                agent_id = self.room_events[room][event_type.value]
 
-    def get_room_events(self, room):
-        all_evts = self.room_events[room]
-        all_evts.extend(self.corpses[room])
-        return all_evts
+            if agent_id != -1:
+                latest = agent_id
+        return latest
 
     def clear_corpses(self):
         self.corpses = [[] for _ in range(self.room_nums)]
 
-    def create_tasks_unique(self, num_tasks, num_visuals):
+    def create_tasks_unique(self, num_tasks, num_visuals, rng=random):
         if num_tasks > len(self.tasks):
             print(f"Asked for {num_tasks} unique tasks, but there are only {len(num_tasks)} available")
             exit(1)
 
-        tasks = random.sample(self.tasks, num_tasks)
+        tasks = rng.sample(self.tasks, num_tasks)
 
         # Set visual
         for i in range(len(tasks)):
@@ -95,42 +166,149 @@ class Map(ABC):
         return tasks
 
     def move_to_meeting_room(self, agent):
-
-        self.rooms[agent.room][agent.agent_id] = 0
-        self.rooms[self.room_meeting][agent.agent_id] = 1
+        self.place_agent(agent.agent_id, self.room_meeting)
         agent.room = self.room_meeting
 
-    # No need for a terribly efficient algorithm: Maps are small
-    # so a simple BFS works
-    def create_nav(self):
-        nav = []
-        # For each starting point, for each goal room, we find the first room in the shortest path to the goal room
-        for starting_room in range(self.room_nums):
+    @staticmethod
+    def get_nav_tables(room_adjacent):
+        key = tuple(tuple(row) for row in room_adjacent)
+        if key not in nav_tables:
+            nav_tables[key] = Map.create_nav_tables(room_adjacent)
+        return nav_tables[key]
 
-            reached = [-1] * self.room_nums
+    @staticmethod
+    def create_nav_tables(room_adjacent):
+        """Returns the adjacent rooms of every room, and the first room on a shortest path and the distance between
+        every pair of rooms, which are -1 if there is no path. A BFS from every room: maps are small"""
+        room_nums = len(room_adjacent)
+        neighbours = [[j for j in range(room_nums) if room_adjacent[i][j]] for i in range(room_nums)]
 
-            # Queue of els: First element is the current location, second the origin/first move in path
-            to_visit = deque()
+        nav = []
+        distances = []
+        for starting_room in range(room_nums):
+            reached = [-1] * room_nums
+            distance = [-1] * room_nums
+            distance[starting_room] = 0
 
-            # We add every room we can enter from the start
-            for j in range(self.room_nums):
-                if not self.room_adjacent[starting_room][j] == 0:
-                    to_visit.append((j, j))
+            # Every room is reached first through the earliest adjacent room of the start it can be reached from
+            to_visit = deque()
+            for room in neighbours[starting_room]:
+                if distance[room] == -1:
+                    reached[room] = room
+                    distance[room] = 1
+                    to_visit.append(room)
 
             while to_visit:
-                check = to_visit.popleft()
-                room = check[0]
-                origin = check[1]
-                if not room == starting_room and reached[room] == -1:
-                    reached[room] = origin
-                    for j in range(self.room_nums):
-                        if self.room_adjacent[room][j]:
-                            to_visit.append((j, origin))
+                room = to_visit.popleft()
+                for j in neighbours[room]:
+                    if distance[j] == -1:
+                        reached[j] = reached[room]
+                        distance[j] = distance[room] + 1
+                        to_visit.append(j)
 
             nav.append(reached)
-
-        return nav
-
+            distances.append(distance)
+
+        return neighbours, nav, distances
+
+
+def load_map_definition(file_name):
+    """
+        Loads a map file: a JSON object with the rooms of the map, each with a name and optionally the coords and
+        width of its spot in the GUI, the edges between rooms as pairs of room names, the tasks, each with the name
+        of its room, a name and whether it is visual, the names of the start and meeting rooms, and optionally the
+        image of the map in the GUI, relative to the folder of the map file.
+        The navigation tables are compiled into a binary cache, keyed by the hash of the file, so only the first
+        process to load a map file computes them.
+    """
+    with open(file_name, "rb") as f:
+        data = f.read()
+    file_hash = hashlib.sha256(data).hexdigest()
+    if file_hash in map_definitions:
+        return map_definitions[file_hash]
+
+    definition = json.loads(data)
+    room_names = [room["name"] for room in definition["rooms"]]
+    room_ids = {name: i for i, name in enumerate(room_names)}
+    if len(room_ids) != len(room_names):
+        raise ValueError(f"Map {file_name} has several rooms with the same name")
+
+    def room_id(name):
+        if name not in room_ids:
+            raise ValueError(f"Map {file_name} refers to room {name}, which it does not define")
+        return room_ids[name]
+
+    room_adjacent = [[0] * len(room_names) for _ in room_names]
+    for a, b in definition["edges"]:
+        room_adjacent[room_id(a)][room_id(b)] = 1
+        room_adjacent[room_id(b)][room_id(a)] = 1
+
+    image = definition.get("image")
+    if image is not None:
+        image = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(file_name)), image))
+
+    definition = {
+        "name": definition.get("name", os.path.basename(file_name)),
+        "image": image,
+        "room_names": room_names,
+        "room_adjacent": room_adjacent,
+        "room_start": room_id(definition["start"]),
+        "room_meeting": room_id(definition["meeting"]),
+        "tasks": [(room_id(task["room"]), task["name"], task.get("visual", False)) for task in definition["tasks"]],
+        "room_coords": [tuple(room["coords"]) if "coords" in room else None for room in definition["rooms"]],
+        "room_width": [room.get("width", 1) for room in definition["rooms"]],
+    }
+
+    key = tuple(tuple(row) for row in room_adjacent)
+    if key not in nav_tables:
+        nav_tables[key] = load_nav_cache(file_name, file_hash, room_adjacent)
+
+    map_definitions[file_hash] = definition
+    return definition
+
+
+def load_nav_cache(file_name, file_hash, room_adjacent):
+    """Returns the navigation tables of a map file from the cache, after compiling them if they are not cached"""
+    cache_folder = os.path.join(os.path.dirname(os.path.abspath(file_name)), NAV_CACHE_FOLDER)
+    cache_file_name = os.path.join(cache_folder, f"{file_hash}.npz")
+
+    neighbours = [[j for j in range(len(room_adjacent)) if room_adjacent[i][j]] for i in range(len(room_adjacent))]
+    if os.path.exists(cache_file_name):
+        with np.load(cache_file_name) as cache:
+            return neighbours, cache["nav"].tolist(), cache["distances"].tolist()
+
+    neighbours, nav, distances = Map.create_nav_tables(room_adjacent)
+
+    # Written to a temporary file first, so that other processes never read a partly written cache.
+    # Where the folder of the map file cannot be written to, the tables are only kept in memory
+    temp_file_name = f"{cache_file_name}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        with open(temp_file_name, "wb") as f:
+            np.savez(f, nav=np.array(nav, dtype=np.int32), distances=np.array(distances, dtype=np.int32))
+        os.replace(temp_file_name, cache_file_name)
+    except OSError:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+
+    return neighbours, nav, distances
+
+
+class FileMap(Map):
+    """A map defined by a map file, see load_map_definition"""
+
+    def __init__(self, file_name, num_agents):
+        definition = load_map_definition(file_name)
+        self.name = definition["name"]
+        self.image = definition["image"]
+        self.room_coords = definition["room_coords"]
+        self.room_width = definition["room_width"]
+
+        # Every map has its own tasks, as whether a task is visual is set per game
+        tasks = [Task(room_id, name, is_visual) for room_id, name, is_visual in definition["tasks"]]
+
+        super().__init__(len(definition["room_names"]), definition["room_names"], definition["room_adjacent"],
+                         definition["room_start"], definition["room_meeting"], tasks, num_agents)
 
 
 '''
@@ -138,40 +316,6 @@ class Map(ABC):
 '''
 
 
-class SimpleSkeld(Map):
+class SimpleSkeld(FileMap):
     def __init__(self, num_agents):
-        room_nums = 13
-        room_names = ["Cafeteria", "Medbay", "Upper Engine", "Reactor", "Security", "Lower Engine", "Electrical",
-                      "Storage", "Admin", "Caf_Med_UpE", "Caf_Adm_Sto", "UpE_LoE_Rea_Sec", "LoE_Ele_Sto"]
-
-        rooms_adjacent = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0],  # Cafeteria
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0],  # Medbay
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 0],  # Upper Engine
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0],  # Reactor
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0],  # Security
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1],  # Lower Engine
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],  # Electrical
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1],  # Storage
-                          [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0],  # Admin
-                          [1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],  # Hallway: Caf_Med_UpE
-                          [1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0],  # Hallway: Caf_Adm_Sto
-                          [0, 0, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0],  # Hallway: UpE_LoE_Rea_Sec
-                          [0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0]   # Hallway: LoE_Ele_Sto
-                          ]
-
-        room_start = 0
-        room_meeting = 0
-
-        # Defined separately for each room/task to allow extending with additional
-        # information such as visual y/n, duration of task, precondition, etc.
-        # As possible extensions for later
-        tasks = [Task(0, "Wires"), Task(0, "Trash"),
-                 Task(1, "Scan", True), Task(1, "Vials"),
-                 Task(2, "Engine"), Task(2, "Fuel"),
-                 Task(3, "Manifolds"), Task(3, "Start reactor"),
-                 Task(5, "Engine"), Task(5, "Fuel"),
-                 Task(6, "Wires"), Task(6, "Align"), Task(6, "Divert power"),
-                 Task(7, "Fuel"), Task(7, "Trash", True),
-                 Task(8, "Swipe")]
-
-        super().__init__(room_nums, room_names, rooms_adjacent, room_start, room_meeting, tasks, num_agents)
\ No newline at end of file
+        super().__init__(SIMPLE_SKELD_FILE, num_agents)
@@ -1,8 +1,13 @@
 """Modal logic formula module
 
 This module unites all operators from propositional and modal logic.
+Formulas are evaluated in a single world with semantic(), or on all worlds
+of a structure at once with extension(), which returns the satisfying worlds
+in the representation of that structure (e.g. a bitmask).
 """
 
+import sys
+
 
 class Atom:
     """
@@ -10,14 +15,20 @@ class Atom:
     """
 
     def __init__(self, name):
-        self.name = name
+        self.name = sys.intern(name) if isinstance(name, str) else name
 
     def semantic(self, ks, world_to_test):
         """Function returns assignment of variable in Kripke's world.
         """
-        for world in ks.worlds:
-            if world.name == world_to_test:
-                return world.assignment.get(self.name, False)
+        world = ks.get_world(world_to_test)
+        if world is not None:
+            return world.assignment.get(self.name, False)
+
+    def extension(self, ks):
+        """Function returns the worlds of the Kripke structure in which the
+        variable is true.
+        """
+        return ks.atom_extension(self.name)
 
     def __eq__(self, other):
         return isinstance(other, Atom) and other.name == self.name
@@ -36,11 +47,13 @@ class Box:
 
     def semantic(self, ks, world_to_test):
         result = True
-        for relation in ks.relations:
-            if relation[0] == world_to_test:
-                result = result and self.inner.semantic(ks, relation[1])
+        for successor in ks.get_successors(world_to_test):
+            result = result and self.inner.semantic(ks, successor)
         return result
 
+    def extension(self, ks):
+        return ks.box_extension(None, self.inner.extension(ks))
+
     def __eq__(self, other):
         return isinstance(other, Box) and self.inner == other.inner
 
@@ -62,11 +75,13 @@ class Box_a:
 
     def semantic(self, ks, world_to_test):
         result = True
-        for relation in ks.relations.get(self.agent, {}):
-            if relation[0] == world_to_test:
-                result = result and self.inner.semantic(ks, relation[1])
+        for successor in ks.get_successors(world_to_test, self.agent):
+            result = result and self.inner.semantic(ks, successor)
         return result
 
+    def extension(self, ks):
+        return ks.box_extension(self.agent, self.inner.extension(ks))
+
     def __eq__(self, other):
         return isinstance(other, Box_a) and self.inner == other.inner and self.agent == other.agent
 
@@ -93,6 +108,12 @@ class Box_star:
             f = And(f, Box_a(agents, self.inner))
         return f.semantic(ks, world_to_test)
 
+    def extension(self, ks):
+        f = self.inner
+        for agents in ks.relations:
+            f = And(f, Box_a(agents, self.inner))
+        return f.extension(ks)
+
     def __eq__(self, other):
         return isinstance(other, Box_star) and self.inner == other.inner
 
@@ -113,11 +134,13 @@ class Diamond:
 
     def semantic(self, ks, world_to_test):
         result = False
-        for relation in ks.relations:
-            if relation[0] == world_to_test:
-                result = result or self.inner.semantic(ks, relation[1])
+        for successor in ks.get_successors(world_to_test):
+            result = result or self.inner.semantic(ks, successor)
         return result
 
+    def extension(self, ks):
+        return ks.diamond_extension(None, self.inner.extension(ks))
+
     def __eq__(self, other):
         return isinstance(other, Diamond) and self.inner == other.inner
 
@@ -139,11 +162,13 @@ class Diamond_a:
 
     def semantic(self, ks, world_to_test):
         result = False
-        for relation in ks.relations.get(self.agent, {}):
-            if relation[0] == world_to_test:
-                result = result or self.inner.semantic(ks, relation[1])
+        for successor in ks.get_successors(world_to_test, self.agent):
+            result = result or self.inner.semantic(ks, successor)
         return result
 
+    def extension(self, ks):
+        return ks.diamond_extension(self.agent, self.inner.extension(ks))
+
     def __eq__(self, other):
         return isinstance(other, Diamond_a) and self.inner == other.inner and self.agent == other.agent
 
@@ -166,6 +191,9 @@ class Implies:
     def semantic(self, ks, world_to_test):
         return not self.left.semantic(ks, world_to_test) or self.right.semantic(ks, world_to_test)
 
+    def extension(self, ks):
+        return ks.complement(self.left.extension(ks)) | self.right.extension(ks)
+
     def __eq__(self, other):
         return self.left == other.left and self.right == other.right
 
@@ -184,6 +212,9 @@ class Not:
     def semantic(self, ks, world_to_test):
         return not self.inner.semantic(ks, world_to_test)
 
+    def extension(self, ks):
+        return ks.complement(self.inner.extension(ks))
+
     def __eq__(self, other):
         return self.inner == other.inner
 
@@ -203,6 +234,9 @@ class And:
     def semantic(self, ks, world_to_test):
         return self.left.semantic(ks, world_to_test) and self.right.semantic(ks, world_to_test)
 
+    def extension(self, ks):
+        return self.left.extension(ks) & self.right.extension(ks)
+
     def __eq__(self, other):
         return self.left == other.left and self.right == other.right
 
@@ -222,6 +256,9 @@ class Or:
     def semantic(self, ks, world_to_test):
         return self.left.semantic(ks, world_to_test) or self.right.semantic(ks, world_to_test)
 
+    def extension(self, ks):
+        return self.left.extension(ks) | self.right.extension(ks)
+
     def __eq__(self, other):
         return self.left == other.left and self.right == other.right
 
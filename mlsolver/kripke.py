@@ -5,6 +5,7 @@ modal logic formula.
 """
 
 import copy
+import sys
 
 from itertools import chain, combinations
 
@@ -19,15 +20,170 @@ class KripkeStructure:
         if isinstance(worlds, list) or isinstance(worlds, dict):
             self.worlds = worlds
             self.relations = relations
+            # Successor index per agent, built on first use. A frame with a
+            # single relation set is stored under the agent None.
+            self.successors = None
+            # Lookup table world name -> World, built on first use.
+            self.world_index = None
+            # Proposition -> set of names of the worlds where it holds, built
+            # on first use.
+            self.valuation = None
         else:
             raise TypeError
 
+    def _get_world_index(self):
+        if self.world_index is None:
+            worlds = self.worlds.values() if isinstance(self.worlds, dict) else self.worlds
+            self.world_index = {world.name: world for world in worlds}
+        return self.world_index
+
+    def get_world(self, world_name):
+        """Returns the world with the given name, or None if it is not part of
+        the structure.
+        """
+        return self._get_world_index().get(world_name)
+
+    def _get_valuation(self):
+        if self.valuation is None:
+            self.valuation = {}
+            for world in self._get_world_index().values():
+                for proposition, value in world.assignment.items():
+                    if value:
+                        self.valuation.setdefault(proposition, set()).add(world.name)
+        return self.valuation
+
+    def atom_extension(self, name):
+        """Returns the set of names of the worlds in which the proposition is
+        true. The returned set must not be modified.
+        """
+        return self._get_valuation().get(name, frozenset())
+
+    def complement(self, extension):
+        return self._get_world_index().keys() - extension
+
+    def box_extension(self, agent, extension):
+        """Returns the names of the worlds of which all successors for agent
+        lie in extension.
+        """
+        return set(name for name in self._get_world_index()
+                   if extension.issuperset(self.get_successors(name, agent)))
+
+    def diamond_extension(self, agent, extension):
+        """Returns the names of the worlds that have at least one successor for
+        agent in extension.
+        """
+        return set(name for name in self._get_world_index()
+                   if not extension.isdisjoint(self.get_successors(name, agent)))
+
+    def box_holds(self, agent, world_name, extension):
+        """Returns true iff all successors of the world for agent lie in
+        extension, i.e. K_agent holds for a formula with that extension.
+        """
+        return extension.issuperset(self.get_successors(world_name, agent))
+
+    def build_successor_index(self):
+        """Builds a mapping agent -> world -> set of successor worlds from the
+        relations, so that the modal operators need not scan every edge.
+        """
+        self.successors = {}
+        if isinstance(self.relations, set):
+            self.successors[None] = self._index_relation(self.relations)
+        elif isinstance(self.relations, dict):
+            for agent, relation in self.relations.items():
+                self.successors[agent] = self._index_relation(relation)
+
+    @staticmethod
+    def _index_relation(relation):
+        index = {}
+        for (start_node, end_node) in relation:
+            index.setdefault(start_node, set()).add(end_node)
+        return index
+
+    def get_successors(self, world_name, agent=None):
+        """Returns the worlds reachable from world_name, for the given agent
+        in a multi-agent structure.
+        """
+        if self.successors is None:
+            self.build_successor_index()
+        return self.successors.get(agent, {}).get(world_name, ())
+
+    def build_indices(self):
+        """Builds all lookup tables up front, e.g. for a structure that is
+        copied many times.
+        """
+        self._get_world_index()
+        self._get_valuation()
+        self.build_successor_index()
+
+    def copy(self):
+        """Returns a copy of the structure, including its lookup tables, that
+        can be updated independently. The World objects are shared, as they
+        are never modified.
+        """
+        if isinstance(self.relations, dict):
+            relations = {agent: relation.copy() for agent, relation in self.relations.items()}
+        else:
+            relations = self.relations.copy()
+        ks = type(self)(self.worlds.copy(), relations)
+
+        if self.world_index is not None:
+            ks.world_index = self.world_index.copy()
+        if self.valuation is not None:
+            ks.valuation = {p: extension.copy() for p, extension in self.valuation.items()}
+        if self.successors is not None:
+            ks.successors = {agent: {world: successors.copy() for world, successors in index.items()}
+                             for agent, index in self.successors.items()}
+        return ks
+
+    def satisfies(self, formula, world_name):
+        return formula.semantic(self, world_name)
+
+    def isolate_nodes(self, agent, node_names):
+        """Removes all edges of one agent that start or end in one of the
+        given nodes.
+        """
+        node_names = set(node_names)
+        relations_to_remove = set()
+        for relation in self.relations[agent]:
+            if relation[0] in node_names or relation[1] in node_names:
+                relations_to_remove.add(relation)
+        self.remove_relations(agent, relations_to_remove)
+
+    def remove_relations(self, agent, relations_to_remove):
+        """Removes the given edges from the relation of one agent and keeps
+        the successor index in sync.
+        """
+        self.relations[agent] = self.relations[agent].difference(relations_to_remove)
+        if self.successors is not None:
+            index = self.successors.get(agent, {})
+            for (start_node, end_node) in relations_to_remove:
+                if start_node in index:
+                    index[start_node].discard(end_node)
+
     def solve(self, formula):
+        """Returns the sub structure in which each node forces a given formula
+        that is the greatest fixpoint of repeatedly removing the failing nodes:
+        nodes that do not force the formula are removed until no such nodes
+        are left. This is not always the largest such sub structure, as a
+        removal can make nodes fail that would otherwise have been kept.
+        """
+        ks = self.copy()
+        nodes_to_remove = ks.nodes_not_follow_formula(formula)
+        while nodes_to_remove:
+            ks.remove_nodes_by_name(nodes_to_remove)
+            nodes_to_remove = ks.nodes_not_follow_formula(formula)
+        return ks
+
+    def solve_power_set(self, formula):
         """Returns a Kripke structure with minimum sub set of nodes, that each
         of it's nodes forces a given formula.
+
+        Reference implementation of solve, exponential in the number of worlds.
+        The two agree on formulas of which the truth in a node does not depend
+        on the other nodes, such as propositional formulas.
         """
         for i, subset in enumerate(self.get_power_set_of_worlds()):
-            ks = KripkeStructure(self.worlds.copy(), copy.deepcopy(self.relations))
+            ks = type(self)(self.worlds.copy(), copy.deepcopy(self.relations))
             for element in subset:
                 ks.remove_node_by_name(element)
             if ks.nodes_not_follow_formula(formula) == []:
@@ -37,21 +193,46 @@ class KripkeStructure:
         """Removes ONE node of Kripke frame, therefore we can make knowledge
         base consistent with announcement.
         """
-        for world in self.worlds.copy():
-            if node_name == world.name:
-                self.worlds.remove(world)
+        self.remove_nodes_by_name([node_name])
+
+    def remove_nodes_by_name(self, node_names):
+        """Removes the given nodes of Kripke frame and all edges from or to
+        them.
+        """
+        node_names = set(node_names)
+        self._remove_worlds(node_names)
 
         if isinstance(self.relations, set):
             for (start_node, end_node) in self.relations.copy():
-                if start_node == node_name or end_node == node_name:
+                if start_node in node_names or end_node in node_names:
                     self.relations.remove((start_node, end_node))
 
         if isinstance(self.relations, dict):
             for key, value in self.relations.items():
                 for (start_node, end_node) in value.copy():
-                    if start_node == node_name or end_node == node_name:
+                    if start_node in node_names or end_node in node_names:
                         value.remove((start_node, end_node))
 
+        if self.successors is not None:
+            for index in self.successors.values():
+                for node_name in node_names:
+                    index.pop(node_name, None)
+                for successors in index.values():
+                    successors.difference_update(node_names)
+
+    def _remove_worlds(self, node_names):
+        for world in self.worlds.copy():
+            if world.name in node_names:
+                self.worlds.remove(world)
+
+        if self.world_index is not None:
+            for node_name in node_names:
+                self.world_index.pop(node_name, None)
+
+        if self.valuation is not None:
+            for extension in self.valuation.values():
+                extension.difference_update(node_names)
+
     def get_power_set_of_worlds(self):
         """Returns a list with all possible sub sets of world names, sorted
         by ascending number of their elements.
@@ -70,11 +251,21 @@ class KripkeStructure:
         """Returns a list with all worlds of Kripke structure, where formula
          is not satisfiable
         """
-        nodes_not_follow_formula = []
-        for nodes in self.worlds:
-            if not formula.semantic(self, nodes.name):
-                nodes_not_follow_formula.append(nodes.name)
-        return nodes_not_follow_formula
+        return self.node_names(self.failing_nodes(formula))
+
+    def failing_nodes(self, formula):
+        """Returns the set of names of the worlds where formula is not
+        satisfied.
+        """
+        return self.complement(formula.extension(self))
+
+    def node_names(self, nodes):
+        """Returns the names of the given set of worlds, in world order."""
+        nodes_names = []
+        for world in self.worlds:
+            if world.name in nodes:
+                nodes_names.append(world.name)
+        return nodes_names
 
     def __eq__(self, other):
         """Returns true iff two Kripke structures are equivalent
@@ -108,6 +299,125 @@ class KripkeStructure:
         return worlds_str + '}, R = ' + str(self.relations) + ')'
 
 
+class S5Relation:
+    """
+    Relation of one agent in an S5 model, stored as a partition of the worlds
+    into equivalence classes instead of as pairs, so it takes memory linear in
+    the number of worlds. Worlds that have been isolated by an update belong
+    to no class and have no successors.
+    """
+
+    def __init__(self, classes):
+        self.classes = [set(members) for members in classes]
+        self.class_of = {}
+        for i, members in enumerate(self.classes):
+            for world_name in members:
+                self.class_of[world_name] = i
+
+    def get_successors(self, world_name):
+        i = self.class_of.get(world_name)
+        return () if i is None else self.classes[i]
+
+    def isolate(self, node_names):
+        """Removes the given worlds from their classes, which removes all
+        edges from or to them.
+        """
+        for world_name in node_names:
+            i = self.class_of.pop(world_name, None)
+            if i is not None:
+                self.classes[i].discard(world_name)
+
+    def copy(self):
+        relation = S5Relation([])
+        relation.classes = [members.copy() for members in self.classes]
+        relation.class_of = self.class_of.copy()
+        return relation
+
+    def __iter__(self):
+        """Yields the relation as pairs of world names."""
+        for members in self.classes:
+            for start_node in members:
+                for end_node in members:
+                    yield start_node, end_node
+
+    def __len__(self):
+        return sum(len(members) ** 2 for members in self.classes)
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __str__(self):
+        return str([members for members in self.classes if members])
+
+
+class S5KripkeStructure(KripkeStructure):
+    """
+    Multi-agent Kripke structure in which the relation of every agent is an
+    S5Relation. Box and diamond are evaluated once per equivalence class and
+    updates remove worlds from the classes of an agent.
+    """
+
+    def build_successor_index(self):
+        """The partitions already are the successor index."""
+        self.successors = {}
+
+    def get_successors(self, world_name, agent=None):
+        relation = self.relations.get(agent)
+        return () if relation is None else relation.get_successors(world_name)
+
+    def _isolated_worlds(self, relation):
+        return set(name for name in self._get_world_index() if name not in relation.class_of)
+
+    def box_extension(self, agent, extension):
+        relation = self.relations.get(agent)
+        if relation is None:
+            return set(self._get_world_index())
+        result = self._isolated_worlds(relation)
+        for members in relation.classes:
+            if extension.issuperset(members):
+                result.update(members)
+        return result
+
+    def diamond_extension(self, agent, extension):
+        relation = self.relations.get(agent)
+        if relation is None:
+            return set()
+        result = set()
+        for members in relation.classes:
+            if not extension.isdisjoint(members):
+                result.update(members)
+        return result
+
+    def isolate_nodes(self, agent, node_names):
+        self.relations[agent].isolate(node_names)
+
+    def remove_relations(self, agent, relations_to_remove):
+        """Removes the given edges from the relation of one agent. The edges
+        that are left must again form a partition, otherwise a ValueError is
+        raised and the relation is not changed.
+        """
+        relation = self.relations[agent]
+        successors = {}
+        for (start_node, end_node) in relation:
+            if (start_node, end_node) not in relations_to_remove:
+                successors.setdefault(start_node, set()).add(end_node)
+
+        classes = []
+        for world_name, members in successors.items():
+            if world_name not in members or any(successors.get(other) != members for other in members):
+                raise ValueError(f"Removing the edges from the relation of agent {agent} does not leave a partition")
+            if min(members) == world_name:
+                classes.append(members)
+
+        self.relations[agent] = S5Relation(classes)
+
+    def remove_nodes_by_name(self, node_names):
+        node_names = set(node_names)
+        self._remove_worlds(node_names)
+        for relation in self.relations.values():
+            relation.isolate(node_names)
+
+
 class World:
     """
     Represents the nodes of Kripke and it extends the graph to Kripke
@@ -116,10 +426,305 @@ class World:
 
     def __init__(self, name, assignment):
         self.name = name
-        self.assignment = assignment
+        # Proposition names are interned, so that lookups with the (also
+        # interned) name of an Atom succeed on identity.
+        self.assignment = {sys.intern(k) if isinstance(k, str) else k: v for k, v in assignment.items()}
 
     def __eq__(self, other):
         return self.name == other.name and self.assignment == other.assignment
 
     def __str__(self):
         return "(" + self.name + ',' + str(self.assignment) + ')'
+
+
+class BitsetKripkeStructure:
+    """
+    Compact alternative to KripkeStructure. Worlds are integer indices, the
+    valuation of each proposition is a bitmask over the worlds and the
+    relation of each agent is a list of rows, where row w is the bitmask of
+    the successors of world w. Formulas are evaluated on all worlds at once
+    via their extension() method, so updates and queries are bitwise
+    operations instead of walks over World objects and name tuples.
+    """
+
+    def __init__(self, world_names, valuation, relations):
+        self.world_names = list(world_names)
+        self.world_ids = {name: i for i, name in enumerate(self.world_names)}
+        self.all_worlds = (1 << len(self.world_names)) - 1
+        self.valuation = valuation
+        self.relations = relations
+        # Per agent, bitmask of the nodes known to have no edges from or to them
+        self.isolated = {}
+
+    @staticmethod
+    def from_kripke_structure(ks):
+        """Converts a multi-agent KripkeStructure, keeping the order of its
+        worlds.
+        """
+        world_names = [world.name for world in ks.worlds]
+        world_ids = {name: i for i, name in enumerate(world_names)}
+
+        valuation = {}
+        for i, world in enumerate(ks.worlds):
+            for proposition, value in world.assignment.items():
+                if value:
+                    valuation[proposition] = valuation.get(proposition, 0) | (1 << i)
+
+        relations = {}
+        for agent, relation in ks.relations.items():
+            rows = [0] * len(world_names)
+            for (start_node, end_node) in relation:
+                rows[world_ids[start_node]] |= 1 << world_ids[end_node]
+            relations[agent] = rows
+
+        return BitsetKripkeStructure(world_names, valuation, relations)
+
+    def to_kripke_structure(self):
+        """Returns the equivalent KripkeStructure, e.g. for plotting."""
+        worlds = []
+        for i, name in enumerate(self.world_names):
+            if self.all_worlds >> i & 1:
+                assignment = {p: bool(mask >> i & 1) for p, mask in self.valuation.items()}
+                worlds.append(World(name, assignment))
+
+        relations = {}
+        for agent, rows in self.relations.items():
+            relations[agent] = set((self.world_names[start], self.world_names[end])
+                                   for start in self.members(self.all_worlds)
+                                   for end in self.members(rows[start]))
+        return KripkeStructure(worlds, relations)
+
+    @staticmethod
+    def members(mask):
+        """Yields the indices of the worlds in a bitmask."""
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def to_mask(self, node_names):
+        mask = 0
+        for name in node_names:
+            mask |= 1 << self.world_ids[name]
+        return mask
+
+    def atom_extension(self, name):
+        return self.valuation.get(name, 0) & self.all_worlds
+
+    def complement(self, extension):
+        return self.all_worlds & ~extension
+
+    def box_extension(self, agent, extension):
+        """Returns the worlds of which all successors for agent lie in
+        extension.
+        """
+        rows = self.relations.get(agent)
+        if rows is None:
+            return self.all_worlds
+        missing = ~extension
+        result = 0
+        for world in self.members(self.all_worlds):
+            if not rows[world] & missing:
+                result |= 1 << world
+        return result
+
+    def diamond_extension(self, agent, extension):
+        """Returns the worlds that have at least one successor for agent in
+        extension.
+        """
+        rows = self.relations.get(agent)
+        if rows is None:
+            return 0
+        result = 0
+        for world in self.members(self.all_worlds):
+            if rows[world] & extension:
+                result |= 1 << world
+        return result
+
+    def satisfies(self, formula, world_name):
+        return bool(formula.extension(self) >> self.world_ids[world_name] & 1)
+
+    def box_holds(self, agent, world_name, extension):
+        """Returns true iff all successors of the world for agent lie in
+        extension, i.e. K_agent holds for a formula with that extension.
+        """
+        rows = self.relations.get(agent)
+        return rows is None or not rows[self.world_ids[world_name]] & ~extension
+
+    def nodes_not_follow_formula(self, formula):
+        """Returns a list with all worlds of the structure where formula is
+        not satisfied, in world order.
+        """
+        return self.node_names(self.failing_nodes(formula))
+
+    def failing_nodes(self, formula):
+        """Returns the bitmask of the worlds where formula is not satisfied."""
+        return self.complement(formula.extension(self))
+
+    def node_names(self, nodes):
+        """Returns the names of the worlds in a bitmask, in world order."""
+        bits = bin(nodes)[:1:-1]
+        return [self.world_names[i] for i, bit in enumerate(bits) if bit == "1"]
+
+    def isolate_nodes(self, agent, nodes):
+        """Removes all edges of one agent that start or end in one of the
+        given nodes, given as a bitmask or as world names.
+        """
+        mask = nodes if isinstance(nodes, int) else self.to_mask(nodes)
+
+        # Repeated announcements mostly concern nodes that are isolated already
+        isolated = self.isolated.get(agent, 0)
+        if not mask & ~isolated:
+            return
+        self.isolated[agent] = isolated | mask
+
+        keep = ~mask
+        self.relations[agent] = [0 if mask >> world & 1 else row & keep
+                                 for world, row in enumerate(self.relations[agent])]
+
+    def build_indices(self):
+        """All lookups are bitmask operations, so there is nothing to build."""
+        pass
+
+    def copy(self):
+        """Returns a copy of the structure that can be updated independently."""
+        ks = BitsetKripkeStructure(self.world_names, self.valuation.copy(),
+                                   {agent: rows.copy() for agent, rows in self.relations.items()})
+        ks.all_worlds = self.all_worlds
+        ks.isolated = self.isolated.copy()
+        return ks
+
+    def solve(self, formula):
+        """Returns the sub structure in which each node forces a given formula
+        that is the greatest fixpoint of repeatedly removing the failing nodes,
+        see KripkeStructure.solve.
+        """
+        ks = self.copy()
+        failing = ks.complement(formula.extension(ks))
+        while failing:
+            ks.remove_nodes(failing)
+            failing = ks.complement(formula.extension(ks))
+        return ks
+
+    def remove_node_by_name(self, node_name):
+        """Removes ONE node of the structure, including all its edges."""
+        self.remove_nodes(1 << self.world_ids[node_name])
+
+    def remove_nodes(self, mask):
+        """Removes the nodes in the bitmask, including all their edges."""
+        keep = ~mask
+        self.all_worlds &= keep
+        for agent, rows in self.relations.items():
+            for world in range(len(rows)):
+                rows[world] = 0 if mask >> world & 1 else rows[world] & keep
+            self.isolated[agent] = self.isolated.get(agent, 0) | mask
+
+    def __str__(self):
+        return str(self.to_kripke_structure())
+
+
+class SubsetKripkeStructure(BitsetKripkeStructure):
+    """
+    Kripke structure of which the worlds are subsets of the agents, e.g. the
+    possible sets of impostors, each encoded as a bitmask over the agents.
+    Proposition j holds in the worlds of which agent j is a member. An agent
+    cannot distinguish the worlds of which it is not a member from each
+    other, and can distinguish each world of which it is a member from all
+    others, so its equivalence classes follow from the subsets and no
+    relation is stored: per agent, only the worlds that updates have
+    isolated are kept. Extensions are bitmasks over the worlds, as in
+    BitsetKripkeStructure.
+    """
+
+    def __init__(self, world_names, subsets, propositions, agents):
+        self.subsets = list(subsets)
+        valuation = {}
+        for w, subset in enumerate(self.subsets):
+            for j in self.members(subset):
+                valuation[propositions[j]] = valuation.get(propositions[j], 0) | (1 << w)
+
+        # Per agent, the bitmask of the worlds it is a member of, which are its singleton classes.
+        # All other worlds form one class.
+        relations = {str(j): valuation.get(propositions[j], 0) for j in agents}
+        super().__init__(world_names, valuation, relations)
+
+    def to_bitset(self):
+        """Returns the equivalent BitsetKripkeStructure, with a row of
+        successors per world.
+        """
+        relations = {}
+        for agent, member_worlds in self.relations.items():
+            keep = self.all_worlds & ~self.isolated.get(agent, 0)
+            others = keep & ~member_worlds
+            relations[agent] = [0 if not keep >> w & 1 else 1 << w if member_worlds >> w & 1 else others
+                                for w in range(len(self.world_names))]
+        ks = BitsetKripkeStructure(self.world_names, self.valuation.copy(), relations)
+        ks.all_worlds = self.all_worlds
+        ks.isolated = self.isolated.copy()
+        return ks
+
+    def to_kripke_structure(self):
+        return self.to_bitset().to_kripke_structure()
+
+    def box_extension(self, agent, extension):
+        member_worlds = self.relations.get(agent)
+        if member_worlds is None:
+            return self.all_worlds
+        isolated = self.isolated.get(agent, 0)
+        keep = self.all_worlds & ~isolated
+        others = keep & ~member_worlds
+        result = (self.all_worlds & isolated) | (keep & member_worlds & extension)
+        if not others & ~extension:
+            result |= others
+        return result
+
+    def diamond_extension(self, agent, extension):
+        member_worlds = self.relations.get(agent)
+        if member_worlds is None:
+            return 0
+        keep = self.all_worlds & ~self.isolated.get(agent, 0)
+        others = keep & ~member_worlds
+        result = keep & member_worlds & extension
+        if others & extension:
+            result |= others
+        return result
+
+    def box_holds(self, agent, world_name, extension):
+        member_worlds = self.relations.get(agent)
+        if member_worlds is None:
+            return True
+        world = self.world_ids[world_name]
+        keep = self.all_worlds & ~self.isolated.get(agent, 0)
+        if not keep >> world & 1:
+            return True
+        if member_worlds >> world & 1:
+            return bool(extension >> world & 1)
+        return not keep & ~member_worlds & ~extension
+
+    def isolate_nodes(self, agent, nodes):
+        """Removes all edges of one agent that start or end in one of the
+        given nodes, given as a bitmask or as world names.
+        """
+        mask = nodes if isinstance(nodes, int) else self.to_mask(nodes)
+        self.isolated[agent] = self.isolated.get(agent, 0) | mask
+
+    def copy(self):
+        """Returns a copy of the structure that can be updated independently.
+        The subsets, valuation and relations are never modified, so they are
+        shared.
+        """
+        ks = SubsetKripkeStructure.__new__(SubsetKripkeStructure)
+        ks.subsets = self.subsets
+        ks.world_names = self.world_names
+        ks.world_ids = self.world_ids
+        ks.valuation = self.valuation
+        ks.relations = self.relations
+        ks.all_worlds = self.all_worlds
+        ks.isolated = self.isolated.copy()
+        return ks
+
+    def remove_nodes(self, mask):
+        """Removes the nodes in the bitmask, including all their edges."""
+        self.all_worlds &= ~mask
+        for agent in self.relations:
+            self.isolated[agent] = self.isolated.get(agent, 0) | mask
@@ -3,9 +3,10 @@
 Module contains a simple Kripke model for Among Us and 
 """
 
-from mlsolver.kripke import KripkeStructure, World
+from mlsolver.kripke import KripkeStructure, BitsetKripkeStructure, S5KripkeStructure, S5Relation, \
+    SubsetKripkeStructure, World
 from mlsolver.formula import Atom, And, Not, Or, Box_a, Box_star
-from logger import Logger
+from logger import Logger, LogEvent
 from graphviz import Digraph
 from abc import abstractmethod
 import pygame
@@ -14,6 +15,8 @@ import os
 import tempfile
 import numpy as np
 
+from itertools import combinations
+
 
 def add_reflexive_edges(worlds, relations):
     """Routine adds reflexive edges to Kripke frame
@@ -40,6 +43,62 @@ def add_symmetric_edges(relations):
     return result
 
 
+def build_impostor_worlds(num_agents, world_names, impostor_sets):
+    """Routine builds one world per set of impostors, in which exactly those agents are impostor
+    """
+    worlds = []
+    for name, impostors in zip(world_names, impostor_sets):
+        worlds.append(World(name, {f"IsImp:{j}": j in impostors for j in range(num_agents)}))
+    return worlds
+
+
+def build_impostor_relation(world_names, impostor_sets, agent):
+    """Routine builds the relation of an agent directly from the partition of the worlds:
+    all worlds in which the agent is not an impostor are connected to each other, and
+    each world in which the agent is an impostor is only connected to itself.
+    Equal to applying add_symmetric_edges and add_reflexive_edges, but linear in the number of edges.
+    """
+    not_involved = [name for name, impostors in zip(world_names, impostor_sets) if agent not in impostors]
+    relation = set((x, y) for x in not_involved for y in not_involved)
+    relation.update((name, name) for name, impostors in zip(world_names, impostor_sets) if agent in impostors)
+    return relation
+
+
+def build_impostor_partition(world_names, impostor_sets, agent):
+    """Routine builds the same relation as build_impostor_relation as an S5 partition: one class with all worlds
+    in which the agent is not an impostor, and a singleton class for each other world
+    """
+    not_involved = [name for name, impostors in zip(world_names, impostor_sets) if agent not in impostors]
+    involved = [[name] for name, impostors in zip(world_names, impostor_sets) if agent in impostors]
+    return S5Relation([not_involved] + involved)
+
+
+def build_impostor_bitset(num_agents, world_names, impostor_sets, agents):
+    """Routine builds the same structure as build_impostor_worlds and build_impostor_relation,
+    as a BitsetKripkeStructure without materialising any pairs of worlds
+    """
+    valuation = {}
+    for w, impostors in enumerate(impostor_sets):
+        for j in impostors:
+            valuation[f"IsImp:{j}"] = valuation.get(f"IsImp:{j}", 0) | (1 << w)
+
+    all_worlds = (1 << len(world_names)) - 1
+    relations = {}
+    for i in agents:
+        not_involved = all_worlds & ~valuation.get(f"IsImp:{i}", 0)
+        relations[str(i)] = [not_involved if not_involved >> w & 1 else 1 << w for w in range(len(world_names))]
+
+    return BitsetKripkeStructure(world_names, valuation, relations)
+
+
+def build_impostor_subsets(num_agents, world_names, impostor_sets, agents):
+    """Routine builds the same structure as build_impostor_worlds and build_impostor_relation,
+    as a SubsetKripkeStructure in which each world is the bitmask of its impostors
+    """
+    subsets = [sum(1 << j for j in impostors) for impostors in impostor_sets]
+    return SubsetKripkeStructure(world_names, subsets, [f"IsImp:{j}" for j in range(num_agents)], agents)
+
+
 def kripke_structure_solve_a(self, agent, formula, print_statement=False):
     """ This function is a small change to mlsolver taken from the code of The Ship at 
     https://github.com/JohnRoyale/MAS2018/blob/master/mlsolver/kripke.py#L36
@@ -48,21 +107,15 @@ def kripke_structure_solve_a(self, agent, formula, print_statement=False):
 
     logger = Logger.get_instance()
 
-    nodes_to_remove = self.nodes_not_follow_formula(formula)
-    if print_statement and len(nodes_to_remove) != 0:
-        logger.log("Removing nodes: {}".format(nodes_to_remove), Logger.PRINT_VISUAL | Logger.LOG)
-    if len(nodes_to_remove) == 0:
+    # The failing nodes are kept in the representation of the structure, names are only needed for logging
+    nodes_to_remove = self.failing_nodes(formula)
+    if print_statement and nodes_to_remove:
+        logger.log_event(LogEvent.REMOVE_NODES, Logger.PRINT_VISUAL | Logger.LOG,
+                         payload=lambda: str(self.node_names(nodes_to_remove)))
+    if not nodes_to_remove:
         return self
 
-    relations_to_remove = []
-
-    for relation in self.relations[str(agent)]:
-        for node in nodes_to_remove:
-            if node in relation:
-                relations_to_remove.append(relation)
-                break
-
-    self.relations[str(agent)] = self.relations[str(agent)].difference(set(relations_to_remove))
+    self.isolate_nodes(str(agent), nodes_to_remove)
     return self
 
 
@@ -97,8 +150,21 @@ def fixed_layout_graphviz(worlds, point, connectivity, r=2, label_pos=0.25):
 
 
 class AmongUsKripke:
-    def __init__(self, num_agents):
+    # Available representations of the Kripke structure, see create_structure
+    ENGINES = ("set", "bitset", "partition", "subset")
+
+    # Initial Kripke structures by (model class, number of agents, number of impostors, engine).
+    # These are never updated themselves:
+    # every game starts from a copy, see setup
+    templates = {}
+
+    def __init__(self, num_agents, num_imp, engine="subset"):
+        if engine not in AmongUsKripke.ENGINES:
+            raise ValueError(f"Unknown Kripke engine: {engine}")
+
         self.num_agents = num_agents
+        self.num_imp = num_imp
+        self.engine = engine
         self.worlds = []
         self.relations = {}
         self.kripke_structure = None
@@ -107,33 +173,106 @@ class AmongUsKripke:
         self.has_received_update = True
         self.buffered_img = None
 
+        # Results of knowledge queries, valid as long as cache_version equals model_version.
+        # The model version is bumped on every update of the Kripke structure.
+        self.model_version = 0
+        self.cache_version = 0
+        self.query_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     @abstractmethod
-    def setup(self):
+    def build_structure(self):
         pass
 
+    def setup(self):
+        """Sets up the initial Kripke structure as a copy of the template for this model, building the
+        template if this is the first model of its kind
+        """
+        key = (type(self), self.num_agents, self.num_imp, self.engine)
+        if key not in AmongUsKripke.templates:
+            template = self.build_structure()
+            template.build_indices()
+            AmongUsKripke.templates[key] = template
+
+        self.kripke_structure = AmongUsKripke.templates[key].copy()
+        if isinstance(self.kripke_structure, KripkeStructure):
+            self.worlds = self.kripke_structure.worlds
+            self.relations = self.kripke_structure.relations
+        self.has_received_update = True
+
     @abstractmethod
     def plot_fixed(self, size=15, label_pos=0.25, render=True):
         pass
 
+    def create_structure(self, world_names, impostor_sets, agents):
+        """Builds the Kripke structure in the representation selected by the engine.
+        world_names and impostor_sets give the name and the impostors of each world, agents are the agents
+        that get a relation: they consider possible every world in which they are not the impostor.
+        The subset engine builds no relations: each world is the bitmask of its impostors, from which the
+        classes of each agent are derived when they are queried.
+        """
+        if self.engine == "subset":
+            return build_impostor_subsets(self.num_agents, world_names, impostor_sets, agents)
+        if self.engine == "bitset":
+            return build_impostor_bitset(self.num_agents, world_names, impostor_sets, agents)
+
+        worlds = build_impostor_worlds(self.num_agents, world_names, impostor_sets)
+        if self.engine == "partition":
+            relations = {str(i): build_impostor_partition(world_names, impostor_sets, i) for i in agents}
+            return S5KripkeStructure(worlds, relations)
+
+        relations = {str(i): build_impostor_relation(world_names, impostor_sets, i) for i in agents}
+        return KripkeStructure(worlds, relations)
+
+    def knows(self, observer, formula):
+        """ Check if the observer knows formula in the real world. The formula is evaluated
+        on the whole model at once, after which only the successors of the real world are checked.
+        """
+        extension = formula.extension(self.kripke_structure)
+        return self.kripke_structure.box_holds(str(observer), self.real_world, extension)
+
+    def invalidate(self):
+        """Registers that the Kripke structure has changed, invalidating all cached query results
+        """
+        self.model_version += 1
+
+    def cached_query(self, kind, observer, other, query):
+        """Returns the result of query, evaluating it only if it has not been asked since the last update
+        """
+        if self.cache_version != self.model_version:
+            self.query_cache.clear()
+            self.cache_version = self.model_version
+
+        key = (kind, observer, other)
+        if key in self.query_cache:
+            self.cache_hits += 1
+            return self.query_cache[key]
+
+        self.cache_misses += 1
+        result = query()
+        self.query_cache[key] = result
+        return result
+
     def suspects(self, observer, other):
         """ Check if agent i suspects agent j of being the impostor
         We do this by evaluating the sentence "i knows not "IsImp:j"
         """
-        sentence = Not(Box_a(str(observer), Not(Atom("IsImp:{}".format(other)))))
-        return sentence.semantic(self.kripke_structure, self.real_world)
+        return self.cached_query("suspects", observer, other,
+                                 lambda: not self.knows(observer, Not(Atom("IsImp:{}".format(other)))))
 
     # If it holds that: other is an impostor and knows that the observer knows that the other is an impostor
     def knows_knows_imp(self, observer, other):
-        sentence = Box_a(str(other), Box_a(str(observer), Atom(f"IsImp:{other}")))
-        return sentence.semantic(self.kripke_structure, self.real_world)
+        return self.cached_query("knows_knows_imp", observer, other,
+                                 lambda: self.knows(other, Box_a(str(observer), Atom(f"IsImp:{other}"))))
 
     def knows_imp(self, observer, other):
-        sentence = Box_a(str(observer), Atom(f"IsImp:{other}"))
-        return sentence.semantic(self.kripke_structure, self.real_world)
+        return self.cached_query("knows_imp", observer, other,
+                                 lambda: self.knows(observer, Atom(f"IsImp:{other}")))
 
     def knows_crew(self, observer, other):
-        sentence = Box_a(str(observer), Not(Atom(f"IsImp:{other}")))
-        return sentence.semantic(self.kripke_structure, self.real_world)
+        return self.cached_query("knows_crew", observer, other,
+                                 lambda: self.knows(observer, Not(Atom(f"IsImp:{other}"))))
 
     def update_known_impostor(self, observer, impostor):
         """Update the model to register that a crewmate has caught the impostor
@@ -141,6 +280,7 @@ class AmongUsKripke:
         sentence = Atom("IsImp:{}".format(impostor))
         self.kripke_structure = kripke_structure_solve_a(self.kripke_structure, str(observer), sentence)
         self.has_received_update = True
+        self.invalidate()
 
     def update_known_crewmate(self, observer, crewmate):
         """Update the model to register that a crewmate no longer suspects another crewmate
@@ -149,10 +289,12 @@ class AmongUsKripke:
         sentence = Not(Atom("IsImp:{}".format(crewmate)))
         self.kripke_structure = kripke_structure_solve_a(self.kripke_structure, str(observer), sentence)
         self.has_received_update = True
+        self.invalidate()
 
     def update(self, observer, sentence):
         if sentence is not None:
             self.kripke_structure = kripke_structure_solve_a(self.kripke_structure, str(observer), sentence, True)
+            self.invalidate()
 
     def retrieve_knowledge(self, observer):
         conjunction = Not(Atom(f"IsImp:{observer}"))
@@ -178,14 +320,18 @@ class AmongUsKripke:
         else:
             self.has_received_update = False
 
+            ks = self.kripke_structure
+            if isinstance(ks, BitsetKripkeStructure):
+                ks = ks.to_kripke_structure()
+
             worlds = list()
             world_id = dict()
-            for i, w in enumerate(self.kripke_structure.worlds):
+            for i, w in enumerate(ks.worlds):
                 world_id[w.name] = i
                 worlds.append(w.name)
             connectivity = {}
 
-            for agent, relations in self.kripke_structure.relations.items():
+            for agent, relations in ks.relations.items():
                 for (start, end) in relations:
                     (start, end) = (min(start, end), max(start, end))
                     if start == end:
@@ -211,98 +357,86 @@ class AmongUsKripke:
 
     def reset(self):
         self.setup()
+        self.invalidate()
 
 
 class AmongUsTwoImp(AmongUsKripke):
-    def __init__(self, num_agents):
-        super().__init__(num_agents)
+    def __init__(self, num_agents, engine="subset"):
+        super().__init__(num_agents, 2, engine)
+        self.real_world = f"Imp{self.num_agents - 2}_{self.num_agents - 1}"
         self.setup()
 
-    def setup(self):
-        self.worlds = []
-        self.relations = {}
-
-        # Build the same number of worlds as there are agents. Each world has one impostor
-        for i in range(self.num_agents):
-            for k in range(i + 1, self.num_agents):
-
-                agent_is_impostor = {}
-                for j in range(self.num_agents):
-                    if i == j or k == j:
-                        agent_is_impostor[f"IsImp:{j}"] = True
-                    else:
-                        agent_is_impostor[f"IsImp:{j}"] = False
-
-                self.worlds.append(World(f"Imp{i}_{k}", agent_is_impostor))
+    def build_structure(self):
+        # Build one world for every pair of agents, in which that pair are the impostors
+        impostor_sets = [(i, k) for i in range(self.num_agents) for k in range(i + 1, self.num_agents)]
+        world_names = [f"Imp{i}_{k}" for (i, k) in impostor_sets]
 
         # Build relations according to the following rules:
         # Each agent knows whether they themselves are impostor or not
         # This leads to crewmates not having accessibility to the worlds where they are impostor
-
-        # Relationships for each agent
-        for i in range(self.num_agents - 2):
-            rels = []
-            # 2 for loops for each possible world
-            for x1 in range(self.num_agents):
-                for y1 in range(x1 + 1, self.num_agents):
-                    for x2 in range(self.num_agents):
-                        for y2 in range(x2 + 1, self.num_agents):
-                            if x1 == x2 and y1 == y2:
-                                continue
-
-                            if i != x1 and i != y1 and i != x2 and i != y2:
-                                rels.append((f"Imp{x1}_{y1}", f"Imp{x2}_{y2}"))
-            self.relations[f"{i}"] = set(rels)
-
-        self.relations.update(add_symmetric_edges(self.relations))
-        self.relations.update(add_reflexive_edges(self.worlds, self.relations))
-        self.kripke_structure = KripkeStructure(self.worlds, self.relations)
-
-        self.real_world = f"Imp{self.num_agents - 2}_{self.num_agents - 1}"
-        self.has_received_update = True
+        # Only crewmates get a relation, the last two agents are the impostors
+        return self.create_structure(world_names, impostor_sets, range(self.num_agents - 2))
 
     def plot_fixed(self):
         return super().plot_fixed()
 
 
 class AmongUsOneImp(AmongUsKripke):
-    def __init__(self, num_agents):
-        super().__init__(num_agents)
+    def __init__(self, num_agents, engine="subset"):
+        super().__init__(num_agents, 1, engine)
 
         # Last index is always the impostor
         self.impostor = num_agents - 1
+        self.real_world = "Imp{}".format(self.impostor)
 
         self.setup()
 
-    def setup(self):
-        self.worlds = []
-        self.relations = {}
-
+    def build_structure(self):
         # Build the same number of worlds as there are agents. Each world has one impostor
-        for i in range(self.num_agents):
-            agent_is_impostor = {}
-            for j in range(self.num_agents):
-                if i == j:
-                    agent_is_impostor["IsImp:{}".format(j)] = True
-                else:
-                    agent_is_impostor["IsImp:{}".format(j)] = False
-
-            self.worlds.append(World("Imp{}".format(i), agent_is_impostor))
+        impostor_sets = [(i,) for i in range(self.num_agents)]
+        world_names = ["Imp{}".format(i) for i in range(self.num_agents)]
 
         # Build relations according to the following rules:
         # Each agent knows whether they themselves are impostor or not
         # This leads to crewmates not having accessibility to the worlds where they are impostor
-        for i in range(self.num_agents):
-            if i is not self.impostor:
-                self.relations[str(i)] = set(
-                    ("Imp{}".format(x), "Imp{}".format(y)) for x in range(self.num_agents) for y in
-                    range(self.num_agents) if
-                    ((i != x) and (i != y)))
-
-        self.relations.update(add_symmetric_edges(self.relations))
-        self.relations.update(add_reflexive_edges(self.worlds, self.relations))
-        self.kripke_structure = KripkeStructure(self.worlds, self.relations)
-        self.real_world = "Imp{}".format(self.impostor)
+        crewmates = [i for i in range(self.num_agents) if i != self.impostor]
+        return self.create_structure(world_names, impostor_sets, crewmates)
 
     def plot_fixed(self):
-        return super().plot_fixed(size=4)
\ No newline at end of file
+        return super().plot_fixed(size=4)
+
+
+class AmongUsNImp(AmongUsKripke):
+    """
+    Kripke model for any number of impostors. There is one world for every set of num_imp agents,
+    in which those agents are the impostors. The worlds are ordered as AmongUsOneImp and AmongUsTwoImp
+    order them, so for one or two impostors the models are the same.
+    With n agents there are n choose num_imp worlds, so on the set and partition engines, which store the
+    relations, large lobbies are slow. The default subset engine stores each world as a bitmask of its
+    impostors and only the worlds that updates have removed from the classes of each crewmate.
+    """
+
+    def __init__(self, num_agents, num_imp, engine="subset"):
+        super().__init__(num_agents, num_imp, engine)
+
+        # The last num_imp agents are always the impostors
+        self.impostors = tuple(range(num_agents - num_imp, num_agents))
+        self.real_world = self.world_name(self.impostors)
+
+        self.setup()
+
+    @staticmethod
+    def world_name(impostors):
+        return "Imp" + "_".join(str(i) for i in impostors)
+
+    def build_structure(self):
+        # Build one world for every subset of num_imp agents, in which that subset are the impostors
+        impostor_sets = list(combinations(range(self.num_agents), self.num_imp))
+        world_names = [self.world_name(impostors) for impostors in impostor_sets]
+
+        # As in the other models, only crewmates get a relation
+        crewmates = range(self.num_agents - self.num_imp)
+        return self.create_structure(world_names, impostor_sets, crewmates)
+
+    def plot_fixed(self):
+        return super().plot_fixed()
@@ -1,7 +1,10 @@
+import os
 import pygame
 from gui.gui_element import Button, MultiLine, get_default_gui_font
 from util.util import LMObject, Message
 
+SPRITES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sprites")
+
 
 class Pane(LMObject):
 
@@ -62,9 +65,9 @@ class MapPane(Pane):
         self.num_imp = num_imp
 
         self.bg_img = map_image
-        self.imp_img = pygame.image.load("sprites/impostor_small.png")
-        self.crew_img = pygame.image.load("sprites/crew_small.png")
-        self.corpse_img = pygame.image.load("sprites/corpse_recoloured_small.png")
+        self.imp_img = pygame.image.load(os.path.join(SPRITES_FOLDER, "impostor_small.png"))
+        self.crew_img = pygame.image.load(os.path.join(SPRITES_FOLDER, "crew_small.png"))
+        self.corpse_img = pygame.image.load(os.path.join(SPRITES_FOLDER, "corpse_recoloured_small.png"))
 
         size = self.bg_img.get_size()
         super().__init__(controller, screen, x, y, size[0], size[1], (255, 255, 255))
@@ -81,37 +84,35 @@ class MapPane(Pane):
 
     def draw_update(self):
         self.sprites_to_draw = []
-        for room, room_corpses, room_coords, room_width in zip(self.game_map.rooms, self.game_map.corpses,
-                                                               self.room_coords, self.room_width):
+        for room, (room_corpses, room_coords, room_width) in enumerate(zip(self.game_map.corpses, self.room_coords,
+                                                                            self.room_width)):
             start_x = room_coords[0]
             start_y = room_coords[1]
             width_used = 0
 
             # We only care about the IDs in the room.
-            corpses_ids_in_room = [c.agent_id for c in room_corpses]
-
-            for i, occupant in enumerate(room):
-                if occupant or i in corpses_ids_in_room:
+            corpses_ids_in_room = {c.agent_id for c in room_corpses}
 
-                    img_to_use = None
-                    if i in corpses_ids_in_room:
-                        img_to_use = self.corpse_img
-                    elif len(room) - i > self.num_imp:
-                        img_to_use = self.crew_img
-                    else:
-                        img_to_use = self.imp_img
+            for i in sorted(corpses_ids_in_room.union(self.game_map.agents_in_room(room))):
+                img_to_use = None
+                if i in corpses_ids_in_room:
+                    img_to_use = self.corpse_img
+                elif self.game_map.num_agents - i > self.num_imp:
+                    img_to_use = self.crew_img
+                else:
+                    img_to_use = self.imp_img
 
-                    size = img_to_use.get_size()
-                    self.sprites_to_draw.append(
-                        self.Agent_Sprite(start_x, start_y, size[0], size[1], i, img_to_use))
+                size = img_to_use.get_size()
+                self.sprites_to_draw.append(
+                    self.Agent_Sprite(start_x, start_y, size[0], size[1], i, img_to_use))
 
-                    start_x += self.crew_img.get_size()[0] + 8
-                    width_used += 1
+                start_x += self.crew_img.get_size()[0] + 8
+                width_used += 1
 
-                    if width_used >= room_width:
-                        width_used = 0
-                        start_x = room_coords[0]
-                        start_y += self.crew_img.get_size()[1] + 8
+                if width_used >= room_width:
+                    width_used = 0
+                    start_x = room_coords[0]
+                    start_y += self.crew_img.get_size()[1] + 8
 
     def handle_click(self, pos, mouse_button):
         if super().handle_click(pos, mouse_button):
@@ -130,15 +131,14 @@ class MapPane(Pane):
             self.draw_update()
 
 
-class SimpleSkeldPane(MapPane):
-    def __init__(self, controller, num_imp, screen, x, y):
-        bg_img = pygame.image.load("sprites/simpleskeld.png")
+class FileMapPane(MapPane):
+    """Draws a map defined by a map file, with the image and room coords of the file"""
 
-        room_coords = [(444, 124), (312, 216), (120, 136), (28, 267), (234, 262), (124, 424), (336, 366),
-                            (474, 440), (624, 340), (258, 130), (524, 286), (130, 228), (266, 482)]
-        room_width = [5, 2, 2, 3, 2, 3, 3, 4, 3, 5, 2, 2, 4]
+    def __init__(self, controller, num_imp, screen, x, y):
+        game_map = controller.game_map
+        bg_img = pygame.image.load(game_map.image)
 
-        super().__init__(controller, num_imp, screen, x, y, bg_img, room_coords, room_width)
+        super().__init__(controller, num_imp, screen, x, y, bg_img, game_map.room_coords, game_map.room_width)
 
 
 class MenuPane(Pane):
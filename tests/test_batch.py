@@ -0,0 +1,57 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+from batch import init_worker, parallel_headless_run, run_shard
+from logger import Logger
+from util.log_reader import load_log
+
+CONFIG = {
+    "num_crew": 8,
+    "num_imp": 2,
+    "num_tasks": 10,
+    "num_visuals": 4,
+    "cooldown": 5,
+    "stat_thres": 0.5,
+    "engine": "subset"
+}
+
+
+def test_worker_returns_shards_larger_than_buffer(tmp_path):
+    """A worker must return all events of a shard, instead of writing them to the log file of the main process
+    when a shard has more events than its buffer"""
+    logger = Logger.get_instance()
+    logger.set_headless_mode(True)
+    logger.clear_logs()
+    shard = (CONFIG, 0, 4, 1)
+    expected, _ = run_shard(shard)
+    logger.clear_logs()
+
+    buffer_size = 100
+    assert len(expected) > buffer_size
+    logger.open_log(str(tmp_path / "worker"), buffer_size)
+    try:
+        with Pool(1, init_worker, (logger.disabled_events,)) as pool:
+            events, _ = pool.apply(run_shard, (shard,))
+    finally:
+        logger.close_log()
+
+    assert events == expected
+    assert len(load_log(tmp_path / "worker.amongus")["events"]) == 0
+
+
+def test_parallel_log_holds_all_runs(tmp_path):
+    logger = Logger.get_instance()
+    logger.set_headless_mode(True)
+    logger.clear_logs()
+
+    num_steps = 8
+    parallel_headless_run(CONFIG, num_steps, 2, 1, chunk_size=2, file_name=str(tmp_path / "parallel"),
+                          log_buffer=100, log_thread=True)
+    log = load_log(tmp_path / "parallel.amongus")
+
+    logger.clear_logs()
+    expected, _ = run_shard((CONFIG, 0, num_steps, 1))
+    assert log["complete"]
+    assert np.array_equal(np.unique(log["events"]["run"]), np.arange(num_steps))
+    assert len(log["events"]) == len(expected)
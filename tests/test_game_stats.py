@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+
+import game_stats
+from game_stats import GameStats, Outcome, create_stats_table, save_game_stats
+from util.log_reader import get_log_files, load_game_stats
+
+
+def create_table(num_games):
+    return create_stats_table([GameStats(run).get_row(Outcome.CREW_TASKS) for run in range(num_games)])
+
+
+def test_overwritten_store_has_no_header_while_columns_are_written(tmp_path, monkeypatch):
+    file_name = str(tmp_path / "stats")
+    save_game_stats(file_name, {"seed": 1}, create_table(3))
+
+    header_file_name = f"{file_name}.amstats/header.json"
+    headers_seen = []
+    save = np.save
+
+    def checked_save(*args, **kwargs):
+        headers_seen.append(os.path.exists(header_file_name))
+        save(*args, **kwargs)
+
+    monkeypatch.setattr(game_stats.np, "save", checked_save)
+    save_game_stats(file_name, {"seed": 2}, create_table(5))
+
+    assert headers_seen and not any(headers_seen)
+    assert get_log_files(str(tmp_path)) == [("stats.amstats", "stats.amstats/header.json")]
+    store = load_game_stats(f"{file_name}.amstats")
+    assert store["run_info"] == {"seed": 2}
+    assert len(store["games"]["run"]) == 5
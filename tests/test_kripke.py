@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from mlsolver.formula import Atom, And, Not, Or
+from mlsolver.kripke import BitsetKripkeStructure
+from mlsolver.model import AmongUsNImp
+
+
+def random_propositional_formula(rng, num_agents, depth):
+    if depth == 0 or rng.random() < 0.3:
+        atom = Atom(f"IsImp:{rng.randrange(num_agents)}")
+        return atom if rng.random() < 0.5 else Not(atom)
+    left = random_propositional_formula(rng, num_agents, depth - 1)
+    right = random_propositional_formula(rng, num_agents, depth - 1)
+    return And(left, right) if rng.random() < 0.5 else Or(left, right)
+
+
+def world_names(ks):
+    return [world.name for world in ks.worlds]
+
+
+@pytest.mark.parametrize("num_agents,num_imp", [(4, 1), (5, 1), (4, 2)])
+def test_solve_agrees_with_power_set_on_propositional_formulas(num_agents, num_imp):
+    rng = random.Random(num_agents)
+    ks = AmongUsNImp(num_agents, num_imp, "set").kripke_structure
+
+    # The announcements of the game are literals, the other formulas combine them
+    formulas = [f(Atom(f"IsImp:{i}")) for i in range(num_agents) for f in (lambda atom: atom, Not)]
+    formulas += [random_propositional_formula(rng, num_agents, 3) for _ in range(20)]
+
+    for formula in formulas:
+        expected = ks.solve_power_set(formula)
+        solved = ks.solve(formula)
+        assert world_names(solved) == world_names(expected)
+        assert solved == expected
+
+        bitset_solved = BitsetKripkeStructure.from_kripke_structure(ks).solve(formula).to_kripke_structure()
+        assert world_names(bitset_solved) == world_names(expected)
+        assert bitset_solved == expected
+
+
+def test_partition_remove_relations_removes_exactly_the_given_edges():
+    ks = AmongUsNImp(5, 1, "set").kripke_structure
+    partition = AmongUsNImp(5, 1, "partition").kripke_structure
+
+    # Removing all edges of some worlds leaves a partition
+    edges = set(edge for edge in ks.relations["0"] if "Imp1" in edge or "Imp2" in edge)
+    ks.remove_relations("0", edges)
+    partition.remove_relations("0", edges)
+    assert set(partition.relations["0"]) == ks.relations["0"]
+
+    # Removing a single edge between two worlds of a class does not
+    before = set(partition.relations["0"])
+    with pytest.raises(ValueError):
+        partition.remove_relations("0", {("Imp3", "Imp4")})
+    assert set(partition.relations["0"]) == before
@@ -1,26 +1,282 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pickle
+import json
 import os
 
+from collections import defaultdict
 from statistics import stdev, mean
+from controller import Phase
+from game_stats import Outcome, GAME_STATS_DTYPE, save_game_stats
+from logger import LogEvent, LOG_FILE_MAGIC, HEADER_BLOCK, CHUNK_BLOCK, FOOTER_BLOCK, HEADER_INFO, CHUNK_INFO, event_text
+
+# The index of the logs in a folder, see update_index
+INDEX_FILE_NAME = ".amongus_index.json"
+
+# The fixed size part of an event record, see logger.EVENT_RECORD
+EVENT_DTYPE = np.dtype([("run", "<u4"), ("step", "<u4"), ("phase", "u1"), ("type", "u1"),
+                        ("a", "<i2"), ("b", "<i2"), ("payload_length", "<u4")])
+
+
+def read_exact(f, size):
+    """Reads size bytes, or returns None if the file ends before that"""
+    data = f.read(size)
+    return data if len(data) == size else None
+
+
+def read_log_blocks(f):
+    """Reads the blocks of a log file up to its footer, or up to where the file was cut off.
+    Returns the header of each section, the chunks (events, payloads) of each section and whether the footer was found"""
+    headers = {}
+    chunks = defaultdict(list)
+
+    while True:
+        block = f.read(1)
+        if block == HEADER_BLOCK:
+            info = read_exact(f, HEADER_INFO.size)
+            if info is None:
+                break
+            section, header_length = HEADER_INFO.unpack(info)
+            header = read_exact(f, header_length)
+            if header is None:
+                break
+            headers[section] = json.loads(header.decode("utf-8"))
+        elif block == CHUNK_BLOCK:
+            info = read_exact(f, CHUNK_INFO.size)
+            if info is None:
+                break
+            section, num_events, payload_length = CHUNK_INFO.unpack(info)
+            records = read_exact(f, num_events * EVENT_DTYPE.itemsize)
+            payloads = read_exact(f, payload_length) if records is not None else None
+            if payloads is None:
+                break
+            chunks[section].append((np.frombuffer(records, dtype=EVENT_DTYPE), payloads))
+        else:
+            return headers, chunks, block == FOOTER_BLOCK
+
+    return headers, chunks, False
+
+
+def create_section_log(header, chunks):
+    """Creates the log of a section from its header and chunks, with the events as a structured array"""
+    log = dict(header)
+    if not chunks:
+        log["events"] = np.zeros(0, dtype=EVENT_DTYPE)
+        log["payload_starts"] = np.zeros(0, dtype=np.int64)
+        log["payloads"] = b""
+        return log
+
+    events = np.concatenate([events for events, _ in chunks])
+    payload_starts = np.zeros(len(events), dtype=np.int64)
+    np.cumsum(events["payload_length"][:-1], out=payload_starts[1:])
+
+    # Chunks of a sweep are written in the order in which they finished, each holding a contiguous range of runs
+    if len(events) > 1 and np.any(events["run"][1:] < events["run"][:-1]):
+        order = np.argsort(events["run"], kind="stable")
+        events = events[order]
+        payload_starts = payload_starts[order]
+
+    log["events"] = events
+    log["payload_starts"] = payload_starts
+    log["payloads"] = b"".join(payloads for _, payloads in chunks)
+    return log
+
 
 def load_log(file_path):
+    """Loads a log file. A log that was cut off, for instance by a crash, holds the events that were written
+    and has complete set to False. Logs written before the event format are pickled text logs, which are still supported"""
     with open(file_path, "rb") as f:
-        return pickle.load(f)
+        if f.read(len(LOG_FILE_MAGIC)) != LOG_FILE_MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+
+        headers, chunks, complete = read_log_blocks(f)
+
+    log = create_section_log(headers.get(0, {"run_info": {}}), chunks[0])
+    log["complete"] = complete
+    if "sweep" in log:
+        log["sweep"] = [create_section_log(headers[section], chunks[section])
+                        for section in range(1, log["sweep"] + 1) if section in headers]
+    return log
+
+
+def load_game_stats(file_path):
+    """Loads a results store, see game_stats.py. Its columns are memory mapped, so only the parts that are used
+    are read. It is returned as a log with the columns of its games instead of events, or as a sweep of such logs"""
+    with open(f"{file_path}/header.json") as f:
+        header = json.load(f)
+    columns = {name: np.load(f"{file_path}/{name}.npy", mmap_mode="r") for name in header["columns"]}
+
+    # The games of a config are a contiguous slice of every column
+    offsets = header["config_offsets"]
+    config_logs = [{"run_info": run_info,
+                    "games": {name: column[offsets[i]:offsets[i + 1]] for name, column in columns.items()}}
+                   for i, run_info in enumerate(header["configs"])]
+
+    if header["sweep"]:
+        return {"run_info": header["run_info"], "sweep": config_logs}
+    return config_logs[0]
 
 
-def load_logs(log_folder):
+def get_log_files(log_folder):
+    """Returns the logs and results stores in a folder, each with the path of the file that is written last.
+    A log that was converted with convert_log is left out, as its results store is used instead"""
+    # Results stores without header are still being written
+    stores = {file_path for file_path in os.listdir(log_folder)
+              if file_path.endswith(".amstats") and os.path.exists(f"{log_folder}/{file_path}/header.json")}
+
+    log_files = []
+    for file_path in sorted(os.listdir(log_folder)):
+        if file_path in stores:
+            log_files.append((file_path, f"{file_path}/header.json"))
+        elif file_path.endswith(".amongus") and file_path[:-len(".amongus")] + ".amstats" not in stores:
+            log_files.append((file_path, file_path))
+    return log_files
+
+
+def load_file_logs(file_path):
+    """Loads a log or results store, and returns the log of each of its configs"""
+    log = load_game_stats(file_path) if file_path.endswith(".amstats") else load_log(file_path)
+
+    # A sweep holds the logs of all of its configs
+    return log["sweep"] if "sweep" in log else [log]
+
+
+def filter_logs(logs, config_filter=None):
+    """Returns the logs of which the run info holds the values in config_filter"""
+    if not config_filter:
+        return logs
+    return [log for log in logs if all(log["run_info"].get(key) == value for key, value in config_filter.items())]
+
+
+def load_logs(log_folder, config_filter=None):
+    """Loads all logs and results stores in a folder. With config_filter, a dict of run info values,
+    only the logs of which the run info holds these values are returned"""
     loaded_logs = []
+    for file_path, _ in get_log_files(log_folder):
+        loaded_logs.extend(load_file_logs(f"{log_folder}/{file_path}"))
+
+    return filter_logs(loaded_logs, config_filter)
+
+
+def summarize_log(log):
+    """Returns the run info, wins and trust statistics of a log, as stored in the index of its folder"""
+    return {"run_info": log["run_info"], "wins": list(get_wins(log)), "trusts": list(get_avg_trusts(log))}
+
+
+def update_index(log_folder):
+    """Returns the index of a folder, which holds the summaries of the logs in every file, see summarize_log.
+    The index is kept in the folder, and only files that are new or changed since they were indexed are loaded"""
+    index_path = f"{log_folder}/{INDEX_FILE_NAME}"
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
 
-    for file_path in os.listdir(log_folder):
-        if file_path.endswith(".amongus"):
-            loaded_logs.append(load_log(f"{log_folder}/{file_path}"))
+    updated_index = {}
+    for file_path, written_path in get_log_files(log_folder):
+        stat = os.stat(f"{log_folder}/{written_path}")
+        entry = index.get(file_path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                     "logs": [summarize_log(log) for log in load_file_logs(f"{log_folder}/{file_path}")]}
+        updated_index[file_path] = entry
 
-    return loaded_logs
+    if updated_index != index:
+        # Replacing the index at once, so that an interrupted update does not leave a broken index behind
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(updated_index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    return updated_index
+
+
+def load_summaries(log_folder, config_filter=None):
+    """Returns the summaries of all logs in a folder from its index, see update_index"""
+    summaries = [summary for entry in update_index(log_folder).values() for summary in entry["logs"]]
+    return filter_logs(summaries, config_filter)
+
+
+def summarize_events(log):
+    """Computes the stats table of an event log, see game_stats.py. Runs that did not end are left out"""
+    events = log["events"]
+    types = events["type"]
+    runs = np.unique(events["run"][types == LogEvent.RUN])
+    run_index = np.searchsorted(runs, events["run"])
+
+    def count(mask):
+        return np.bincount(run_index[mask], minlength=len(runs))
+
+    table = np.zeros(len(runs), dtype=GAME_STATS_DTYPE)
+    table["run"] = runs
+
+    phases = types == LogEvent.PHASE
+    table["rounds"] = count(phases & (events["phase"] == Phase.ACT.value))
+    table["meetings"] = count(phases & (events["phase"] == Phase.DISCUSS.value))
+    table["kills"] = count(types == LogEvent.KILL)
+    table["voted_off"] = count(types == LogEvent.VOTED_OFF)
+
+    # Each distinct (run, truster, trusted) combination is one trust relation
+    trusts = events[types == LogEvent.TRUST]
+    relations = np.unique((trusts["run"].astype(np.int64) << 32) |
+                          ((trusts["a"].astype(np.int64) & 0xFFFF) << 16) |
+                          (trusts["b"].astype(np.int64) & 0xFFFF))
+    table["trusts"] = np.bincount(np.searchsorted(runs, relations >> 32), minlength=len(runs))
+
+    ended = np.zeros(len(runs), dtype=bool)
+    for event_type, outcome in ((LogEvent.CREW_WIN_VOTE, Outcome.CREW_VOTE),
+                                (LogEvent.CREW_WIN_TASKS, Outcome.CREW_TASKS),
+                                (LogEvent.IMP_WIN, Outcome.IMPOSTORS)):
+        index = run_index[types == event_type]
+        table["outcome"][index] = outcome
+        ended[index] = True
+
+    return table[ended]
+
+
+def convert_log(file_path):
+    """Saves the stats tables of an event log as a results store next to it, which is much faster to analyse"""
+    log = load_log(file_path)
+    if "sweep" in log:
+        games = [(config_log["run_info"], summarize_events(config_log)) for config_log in log["sweep"]]
+    else:
+        games = summarize_events(log)
+    save_game_stats(file_path[:-len(".amongus")], log["run_info"], games)
+
+
+def get_win_rates(log):
+    """Returns the fractions of runs won by the crewmates by voting, by the crewmates by tasks and by the impostors"""
+    wins = np.array(get_wins(log), dtype=float)
+    return tuple(float(rate) for rate in wins / max(1, wins.sum()))
+
+
+def get_payload(log, i):
+    """Returns the payload of the i-th event of a log"""
+    start = log["payload_starts"][i]
+    return log["payloads"][start:start + log["events"][i]["payload_length"]].decode("utf-8")
+
+
+def get_log_text(log):
+    """Returns the text of every event in a log"""
+    if "events" not in log:
+        return log["logs"]
+
+    return [event_text((*event.tolist()[:-1], get_payload(log, i))) for i, event in enumerate(log["events"])]
 
 
 def get_wins(log):
+    if "games" in log:
+        counts = np.bincount(log["games"]["outcome"], minlength=len(Outcome))
+        return int(counts[Outcome.CREW_VOTE]), int(counts[Outcome.CREW_TASKS]), int(counts[Outcome.IMPOSTORS])
+    if "events" not in log:
+        return get_wins_text(log)
+
+    counts = np.bincount(log["events"]["type"], minlength=len(LogEvent))
+    return (int(counts[LogEvent.CREW_WIN_VOTE.value]), int(counts[LogEvent.CREW_WIN_TASKS.value]),
+            int(counts[LogEvent.IMP_WIN.value]))
+
+
+def get_wins_text(log):
     win_crew_vote = 0
     win_crew_tasks = 0
     win_imp = 0
@@ -37,14 +293,27 @@ def get_wins(log):
 
 
 def find_log_around(log, sentence_to_find, num_context=3):
-    for i in range(len(log["logs"])):
-        if log["logs"][i].__contains__(sentence_to_find):
+    lines = get_log_text(log)
+    for i in range(len(lines)):
+        if lines[i].__contains__(sentence_to_find):
             print("--------------------")
-            for j in range(i-num_context, min(i+num_context+1, len(log["logs"]))):
-                print(f"{j}| {log['logs'][j]}")
+            for j in range(i-num_context, min(i+num_context+1, len(lines))):
+                print(f"{j}| {lines[j]}")
 
 
 def get_avg_trusts(log):
+    """Returns the mean and standard deviation over all runs of the number of distinct trust relations in a run"""
+    if "events" in log:
+        trusts = summarize_events(log)["trusts"]
+    elif "games" in log:
+        trusts = log["games"]["trusts"]
+    else:
+        return get_avg_trusts_text(log)
+
+    return float(np.mean(trusts)), float(np.std(trusts, ddof=1))
+
+
+def get_avg_trusts_text(log):
 
     trusts = None
     i = 0
@@ -76,12 +345,12 @@ def get_avg_trusts(log):
     return mean(outcomes), stdev(outcomes)
 
 
-def plot_variable_kills(name_of_variable, log_folder):
-    loaded_logs = load_logs(log_folder)
+def plot_variable_kills(name_of_variable, log_folder, config_filter=None):
+    summaries = load_summaries(log_folder, config_filter)
 
     results = {}
-    for log in loaded_logs:
-        results[log["run_info"][name_of_variable]] = get_wins(log)
+    for summary in summaries:
+        results[summary["run_info"][name_of_variable]] = summary["wins"]
 
     sorted_keys = sorted(results.keys())
 
@@ -111,12 +380,12 @@ def plot_variable_kills(name_of_variable, log_folder):
     plt.show()
 
 
-def plot_variable_trusts(name_of_variable, log_folder):
-    loaded_logs = load_logs(log_folder)
+def plot_variable_trusts(name_of_variable, log_folder, config_filter=None):
+    summaries = load_summaries(log_folder, config_filter)
 
     results = {}
-    for log in loaded_logs:
-        results[log["run_info"][name_of_variable]] = list(get_avg_trusts(log))
+    for summary in summaries:
+        results[summary["run_info"][name_of_variable]] = summary["trusts"]
 
     sorted_keys = sorted(results.keys())
     outcomes = [results[k][0] for k in sorted_keys]